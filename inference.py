@@ -8,84 +8,103 @@ from argparse import ArgumentParser
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff  
 from src.facerender.animate import AnimateFromCoeff
-from src.generate_batch import get_data
+from src.generate_batch import get_data, load_audio
 from src.generate_facerender_batch import get_facerender_data
 from src.utils.init_path import init_path
+from src.utils.preprocess_cache import PreprocessCache, AudioFeatureCache
+from src.utils.coeff_io import save_coeffs
+
+def extract_refs(args, preprocess_model, save_dir):
+    """ coeffs of the reference videos providing eye blinking and pose, or None """
+    ref_eyeblink = args.ref_eyeblink
+    ref_pose = args.ref_pose
+
+    if ref_eyeblink is not None:
+        print('3DMM Extraction for the reference video providing eye blinking')
+        ref_eyeblink_coeff = preprocess_model.extract(ref_eyeblink, args.preprocess, source_image_flag=False, track_landmarks=args.track_landmarks)
+        if args.verbose:
+            ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_coeff['pic_name'])
+            os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
+            preprocess_model.save(ref_eyeblink_coeff, ref_eyeblink_frame_dir)
+    else:
+        ref_eyeblink_coeff=None
+
+    if ref_pose is not None:
+        if ref_pose == ref_eyeblink: 
+            ref_pose_coeff = ref_eyeblink_coeff
+        else:
+            print('3DMM Extraction for the reference video providing pose')
+            ref_pose_coeff = preprocess_model.extract(ref_pose, args.preprocess, source_image_flag=False, track_landmarks=args.track_landmarks)
+            if args.verbose:
+                ref_pose_frame_dir = os.path.join(save_dir, ref_pose_coeff['pic_name'])
+                os.makedirs(ref_pose_frame_dir, exist_ok=True)
+                preprocess_model.save(ref_pose_coeff, ref_pose_frame_dir)
+    else:
+        ref_pose_coeff=None
+    return ref_eyeblink_coeff, ref_pose_coeff
 
 def main(args):
     #torch.backends.cudnn.enabled = False
 
-    pic_path = args.source_image
+    pic_path = args.source_image[0]
     audio_path = args.driven_audio
     save_dir = os.path.join(args.result_dir, strftime("%Y_%m_%d_%H.%M.%S"))
     os.makedirs(save_dir, exist_ok=True)
     pose_style = args.pose_style
     device = args.device
-    batch_size = args.batch_size
+    batch_size = args.batch_size or 2
     input_yaw_list = args.input_yaw
     input_pitch_list = args.input_pitch
     input_roll_list = args.input_roll
-    ref_eyeblink = args.ref_eyeblink
-    ref_pose = args.ref_pose
 
     current_root_path = os.path.split(sys.argv[0])[0]
 
     sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
 
     #init model
-    preprocess_model = CropAndExtract(sadtalker_paths, device)
+    preprocess_cache = PreprocessCache(args.preprocess_cache_dir, int(args.preprocess_cache_size * 1024**3)) if args.preprocess_cache_dir else None
+    preprocess_model = CropAndExtract(sadtalker_paths, device, preprocess_cache)
 
-    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device)
+    audio_cache = AudioFeatureCache(args.audio_cache_dir, int(args.audio_cache_size * 1024**3)) if args.audio_cache_dir else None
+    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device, audio_cache)
     
     animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
 
     #crop image and extract 3dmm from image
-    first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
-    os.makedirs(first_frame_dir, exist_ok=True)
+    # the stages hand their arrays over in memory, --verbose also writes them to save_dir
     print('3DMM Extraction for source image')
-    first_coeff_path, crop_pic_path, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
-                                                                             source_image_flag=True, pic_size=args.size)
-    if first_coeff_path is None:
+    first_coeff = preprocess_model.extract(pic_path, args.preprocess, source_image_flag=True, pic_size=args.size)
+    if first_coeff is None:
         print("Can't get the coeffs of the input")
         return
+    crop_info = first_coeff['crop_info']
+    if args.verbose:
+        first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
+        os.makedirs(first_frame_dir, exist_ok=True)
+        preprocess_model.save(first_coeff, first_frame_dir)
 
-    if ref_eyeblink is not None:
-        ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[0]
-        ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
-        os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
-        print('3DMM Extraction for the reference video providing eye blinking')
-        ref_eyeblink_coeff_path, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False)
-    else:
-        ref_eyeblink_coeff_path=None
-
-    if ref_pose is not None:
-        if ref_pose == ref_eyeblink: 
-            ref_pose_coeff_path = ref_eyeblink_coeff_path
-        else:
-            ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
-            ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
-            os.makedirs(ref_pose_frame_dir, exist_ok=True)
-            print('3DMM Extraction for the reference video providing pose')
-            ref_pose_coeff_path, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False)
-    else:
-        ref_pose_coeff_path=None
+    ref_eyeblink_coeff, ref_pose_coeff = extract_refs(args, preprocess_model, save_dir)
 
     #audio2ceoff
-    batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
-    coeff_path = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+    batch = get_data(first_coeff, audio_path, device, ref_eyeblink_coeff, still=args.still, lazy_mels=args.stream_chunk is not None, audio_cache=audio_cache)
+    coeff = audio_to_coeff.predict(batch, pose_style, ref_pose_coeff, chunk_size=args.stream_chunk, seed=args.seed)
+    if args.verbose:
+        coeff['coeff_path'] = save_coeffs(os.path.join(save_dir, coeff['video_name']+'.npz'), coeff_3dmm=coeff['coeff_3dmm'])
 
     # 3dface render
     if args.face3dvis:
         from src.face3d.visualize import gen_composed_video
-        gen_composed_video(args, device, first_coeff_path, coeff_path, audio_path, os.path.join(save_dir, '3dface.mp4'))
+        gen_composed_video(args, device, first_coeff, coeff, audio_path, os.path.join(save_dir, '3dface.mp4'))
     
     #coeff2video
-    data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, 
+    data = get_facerender_data(coeff, first_coeff['crop_pic'], first_coeff, audio_path, 
                                 batch_size, input_yaw_list, input_pitch_list, input_roll_list,
-                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size, \
+                                stream=args.stream_chunk is not None, dump_txt=args.verbose)
     
     result = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
-                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size)
+                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size, \
+                                render_chunk_size=args.render_chunk_size, stream_chunk=args.stream_chunk)
     
     shutil.move(result, save_dir+'.mp4')
     print('The generated video is named:', save_dir+'.mp4')
@@ -93,19 +112,100 @@ def main(args):
     if not args.verbose:
         shutil.rmtree(save_dir)
 
+
+def main_batch(args):
+    """
+    One driving audio, many source images: the audio is processed once, the coefficients of all
+    avatars are predicted in one batch and the avatars are rendered together, one video per image.
+    """
+    audio_path = args.driven_audio
+    save_dir = os.path.join(args.result_dir, strftime("%Y_%m_%d_%H.%M.%S"))
+    os.makedirs(save_dir, exist_ok=True)
+    device = args.device
+
+    current_root_path = os.path.split(sys.argv[0])[0]
+
+    sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
+
+    #init model
+    preprocess_cache = PreprocessCache(args.preprocess_cache_dir, int(args.preprocess_cache_size * 1024**3)) if args.preprocess_cache_dir else None
+    preprocess_model = CropAndExtract(sadtalker_paths, device, preprocess_cache)
+
+    audio_cache = AudioFeatureCache(args.audio_cache_dir, int(args.audio_cache_size * 1024**3)) if args.audio_cache_dir else None
+    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device, audio_cache)
+    
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+
+    avatars = []
+    for pic_path in args.source_image:
+        print('3DMM Extraction for source image', pic_path)
+        first_coeff = preprocess_model.extract(pic_path, args.preprocess, source_image_flag=True, pic_size=args.size)
+        if first_coeff is None:
+            print("Can't get the coeffs of the input", pic_path)
+            continue
+        # one output folder per avatar, numbered when several images have the same name
+        names = [avatar['name'] for avatar in avatars]
+        name = first_coeff['pic_name'] if first_coeff['pic_name'] not in names else '%s_%d' % (first_coeff['pic_name'], len(avatars))
+        avatar_dir = os.path.join(save_dir, name)
+        os.makedirs(avatar_dir, exist_ok=True)
+        if args.verbose:
+            first_frame_dir = os.path.join(avatar_dir, 'first_frame_dir')
+            os.makedirs(first_frame_dir, exist_ok=True)
+            preprocess_model.save(first_coeff, first_frame_dir)
+        avatars.append({'name': name, 'pic_path': pic_path, 'dir': avatar_dir, 'first_coeff': first_coeff})
+    if not avatars:
+        return
+
+    ref_eyeblink_coeff, ref_pose_coeff = extract_refs(args, preprocess_model, save_dir)
+
+    #audio2ceoff, the mel spectrogram is computed once for all avatars
+    audio_data = load_audio(audio_path, audio_cache)
+    batches = [get_data(avatar['first_coeff'], audio_path, device, ref_eyeblink_coeff, still=args.still, audio_cache=audio_cache, audio_data=audio_data)
+               for avatar in avatars]
+    coeffs = audio_to_coeff.predict_batch(batches, args.pose_style, ref_pose_coeff, seed=args.seed)
+
+    #coeff2video, the sources are stacked along the batch of the face renderer
+    datas = []
+    for avatar, coeff in zip(avatars, coeffs):
+        if args.verbose:
+            coeff['coeff_path'] = save_coeffs(os.path.join(avatar['dir'], coeff['video_name']+'.npz'), coeff_3dmm=coeff['coeff_3dmm'])
+        first_coeff = avatar['first_coeff']
+        if args.face3dvis:
+            from src.face3d.visualize import gen_composed_video
+            gen_composed_video(args, device, first_coeff, coeff, audio_path, os.path.join(avatar['dir'], '3dface.mp4'))
+        datas.append(get_facerender_data(coeff, first_coeff['crop_pic'], first_coeff, audio_path, 
+                                         1, args.input_yaw, args.input_pitch, args.input_roll,
+                                         expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size,
+                                         stream=True, dump_txt=args.verbose))
+    # up to --max_avatars sources per generator pass, every avatar is pasted back, enhanced and muxed on its own as its frames arrive
+    results = animate_from_coeff.generate_batch(datas, [avatar['dir'] for avatar in avatars], [avatar['pic_path'] for avatar in avatars],
+                                                [avatar['first_coeff']['crop_info'] for avatar in avatars], \
+                                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size, \
+                                                render_chunk_size=args.render_chunk_size or args.stream_chunk or 8, max_avatars=args.max_avatars)
+
+    for avatar, result in zip(avatars, results):
+        shutil.move(result, avatar['dir']+'.mp4')
+        print('The generated video is named:', avatar['dir']+'.mp4')
+
+        if not args.verbose:
+            shutil.rmtree(avatar['dir'])
+
     
 if __name__ == '__main__':
 
     parser = ArgumentParser()  
     parser.add_argument("--driven_audio", default='./examples/driven_audio/bus_chinese.wav', help="path to driven audio")
-    parser.add_argument("--source_image", default='./examples/source_image/full_body_1.png', help="path to source image")
+    parser.add_argument("--source_image", nargs='+', default=['./examples/source_image/full_body_1.png'], help="path to source image, several images are animated together with the same audio")
     parser.add_argument("--ref_eyeblink", default=None, help="path to reference video providing eye blinking")
     parser.add_argument("--ref_pose", default=None, help="path to reference video providing pose")
     parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to output")
     parser.add_argument("--result_dir", default='./results', help="path to output")
     parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
-    parser.add_argument("--batch_size", type=int, default=2,  help="the batch size of facerender")
+    parser.add_argument("--batch_size", type=int, default=None,  help="the batch size of facerender (2), a single source image only")
     parser.add_argument("--size", type=int, default=256,  help="the image size of the facerender")
+    parser.add_argument("--render_chunk_size", type=int, default=None,  help="render this many frames per generator pass with the batched face renderer")
+    parser.add_argument("--stream_chunk", type=int, default=None,  help="process long audio in chunks of this many frames to keep the memory bounded, in audio2coeff and the face renderer (only the renderer with several source images)")
+    parser.add_argument("--max_avatars", type=int, default=4,  help="render at most this many source images per generator pass")
     parser.add_argument("--expression_scale", type=float, default=1.,  help="the batch size of facerender")
     parser.add_argument('--input_yaw', nargs='+', type=int, default=None, help="the input yaw degree of the user ")
     parser.add_argument('--input_pitch', nargs='+', type=int, default=None, help="the input pitch degree of the user")
@@ -116,6 +216,12 @@ if __name__ == '__main__':
     parser.add_argument("--face3dvis", action="store_true", help="generate 3d face and 3d landmarks") 
     parser.add_argument("--still", action="store_true", help="can crop back to the original videos for the full body aniamtion") 
     parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images" ) 
+    parser.add_argument("--track_landmarks", action="store_true", help="only run the face detector on keyframes of the reference videos" ) 
+    parser.add_argument("--preprocess_cache_dir", default=None, help="reuse the crop, landmarks and 3dmm coefficients of inputs seen before from this folder" ) 
+    parser.add_argument("--preprocess_cache_size", type=float, default=2., help="size limit of the preprocessing cache in GB" ) 
+    parser.add_argument("--audio_cache_dir", default=None, help="reuse the mel spectrogram and audio features of driving audios seen before from this folder" ) 
+    parser.add_argument("--audio_cache_size", type=float, default=1., help="size limit of the audio cache in GB" ) 
+    parser.add_argument("--seed", type=int, default=None, help="random seed of the generated head poses, for reproducible results" ) 
     parser.add_argument("--verbose",action="store_true", help="saving the intermedia output or not" ) 
     parser.add_argument("--old_version",action="store_true", help="use the pth other than safetensor version" ) 
 
@@ -141,5 +247,11 @@ if __name__ == '__main__':
     else:
         args.device = "cpu"
 
-    main(args)
+    if len(args.source_image) > 1:
+        # the avatars are always rendered chunk by chunk, --stream_chunk/--render_chunk_size set the frames per avatar and pass
+        if args.batch_size is not None:
+            parser.error('--batch_size only applies to a single --source_image, use --render_chunk_size with several source images')
+        main_batch(args)
+    else:
+        main(args)
 
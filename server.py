@@ -0,0 +1,204 @@
+"""Long-lived inference service: models are loaded once per (size, preprocess) variant and
+requests are served from a queue over a local HTTP port or Unix socket. The input paths of a request
+are resolved under --input_root and the videos are written to --result_dir.
+
+    python server.py --port 7861 --warmup 256:crop --input_root ./inputs
+    curl -X POST localhost:7861/generate -d '{"source_image": "a.png", "driven_audio": "b.wav"}'
+"""
+import os
+import json
+import queue
+import shutil
+import tempfile
+import threading
+import socketserver
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from src.gradio_demo import SadTalker
+from src.generate_facerender_batch import get_facerender_data
+
+
+# keyword arguments of SadTalker.test that a request may set, the output folder is fixed by the server
+REQUEST_KEYS = ['preprocess', 'still_mode', 'use_enhancer', 'batch_size', 'size', 'pose_style', 'exp_scale',
+                'use_ref_video', 'ref_video', 'ref_info', 'use_idle_mode', 'length_of_audio', 'use_blink']
+# request keys that are input files, they must lie under the input root
+INPUT_KEYS = ['source_image', 'driven_audio', 'ref_video']
+
+
+def resolve_input(path, root):
+    """ `path` (relative to `root`) as a real path, None when it points outside of `root` """
+    path = os.path.realpath(os.path.join(root, path))
+    return path if os.path.commonpath([path, root]) == root else None
+
+
+def warmup_models(models, size, preprocess, device, num_frames=8):
+    """ one pass of a blank image and silent audio through the detector, FAN, net_recon, audio2coeff and the face renderer """
+    frame = np.zeros((size, size, 3), np.uint8)
+    preprocess_model = models['preprocess_model']
+    preprocess_model.propress.predictor.det_net.detect_faces(frame, 0.97)
+    preprocess_model.propress.predictor.detector.get_landmarks(frame)
+    preprocess_model.net_recon(torch.zeros(1, 3, 224, 224, device=device))
+
+    batch = {'ref': torch.zeros(1, num_frames, 70, device=device),
+             'ratio_gt': torch.zeros(1, num_frames, 1, device=device),
+             'indiv_mels': torch.zeros(1, num_frames, 1, 80, 16, device=device),
+             'num_frames': num_frames, 'pic_name': 'warmup', 'audio_name': 'warmup'}
+    coeff = models['audio_to_coeff'].predict(batch, 0)
+
+    first_coeff = {'coeff_3dmm': np.zeros((1, 73), np.float32)}
+    data = get_facerender_data(coeff, frame, first_coeff, None, 1, preprocess=preprocess, size=size, stream=True)
+    animate_from_coeff = models['animate_from_coeff']
+    for _ in animate_from_coeff.iter_frames(data, num_frames, ((size, size), None, None), size):
+        pass
+    # the blank source must not take a slot of the avatar cache
+    animate_from_coeff.source_cache.clear()
+
+
+class InferenceWorker():
+    """ Runs the queued jobs one by one on the resident models. """
+
+    def __init__(self, sad_talker, max_queue=16, result_dir='./results'):
+        self.sad_talker = sad_talker
+        self.result_dir = result_dir
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def warmup(self, variants):
+        """ load the models of each variant and push a tiny dummy input through each of them, so the
+        cuDNN autotuning and the allocator growth are not paid by the first request """
+        for size, preprocess in variants:
+            print(f'warm up models for size={size}, preprocess={preprocess}')
+            models = self.sad_talker.load_models(size, preprocess)
+            with torch.no_grad():
+                warmup_models(models, size, preprocess, self.sad_talker.device)
+
+    def submit(self, params):
+        job = {'params': params, 'done': threading.Event(), 'result': None, 'error': None}
+        self.jobs.put_nowait(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                job['result'] = self._generate(**job['params'])
+            except Exception as e:
+                job['error'] = repr(e)
+            finally:
+                job['done'].set()
+                self.jobs.task_done()
+
+    def _generate(self, source_image, driven_audio=None, **kwargs):
+        # SadTalker.test moves its inputs into the result folder, keep the caller's files intact
+        input_dir = tempfile.mkdtemp()
+        try:
+            source_image = shutil.copy(source_image, input_dir)
+            if driven_audio is not None:
+                driven_audio = shutil.copy(driven_audio, input_dir)
+            return self.sad_talker.test(source_image, driven_audio, result_dir=self.result_dir, **kwargs)
+        finally:
+            shutil.rmtree(input_dir, ignore_errors=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    worker = None
+    input_root = None
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._reply(404, {'error': 'unknown path'})
+        self._reply(200, {'status': 'ok', 'queued': self.worker.jobs.qsize(),
+                          'models': ['%d:%s' % key for key in self.worker.sad_talker.models]})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self._reply(404, {'error': 'unknown path'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            params = {k: request[k] for k in REQUEST_KEYS if k in request}
+            params['source_image'] = request['source_image']
+            params['driven_audio'] = request.get('driven_audio')
+            inputs = {k: resolve_input(params[k], self.input_root) for k in INPUT_KEYS if params.get(k) is not None}
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': repr(e)})
+        outside = [k for k, path in inputs.items() if path is None]
+        if outside:
+            return self._reply(403, {'error': '%s outside of the input root' % ', '.join(outside)})
+        params.update(inputs)
+
+        try:
+            job = self.worker.submit(params)
+        except queue.Full:
+            return self._reply(503, {'error': 'queue is full'})
+
+        job['done'].wait()
+        if job['error'] is not None:
+            return self._reply(500, {'error': job['error']})
+        self._reply(200, {'video': os.path.abspath(job['result'])})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_variant(text):
+    size, preprocess = text.split(':')
+    return int(size), preprocess
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--config_dir", default='./src/config', help="path to the configs")
+    parser.add_argument("--host", default='127.0.0.1', help="host of the http api")
+    parser.add_argument("--port", type=int, default=7861, help="port of the http api")
+    parser.add_argument("--socket", default=None, help="serve on this unix socket instead of a tcp port")
+    parser.add_argument("--max_queue", type=int, default=16, help="number of requests that can wait for the models")
+    parser.add_argument("--input_root", default='.', help="requests may only read input files under this folder")
+    parser.add_argument("--result_dir", default='./results', help="folder of the generated videos")
+    parser.add_argument("--preprocess_cache_dir", default=None, help="keep the preprocessing results of repeated avatars in this folder")
+    parser.add_argument("--audio_cache_dir", default=None, help="keep the mel spectrograms and audio features of repeated driving audios in this folder")
+    parser.add_argument("--warmup", nargs='+', type=parse_variant, default=[(256, 'crop')], help="model variants to load at startup, as size:preprocess")
+
+    args = parser.parse_args()
+
+    sad_talker = SadTalker(args.checkpoint_dir, args.config_dir, keep_models=True, preprocess_cache_dir=args.preprocess_cache_dir,
+                           audio_cache_dir=args.audio_cache_dir)
+    worker = InferenceWorker(sad_talker, max_queue=args.max_queue, result_dir=args.result_dir)
+    worker.warmup(args.warmup)
+    RequestHandler.worker = worker
+    RequestHandler.input_root = os.path.realpath(args.input_root)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        httpd = ThreadingUnixHTTPServer(args.socket, RequestHandler)
+        print('SadTalker server listening on', args.socket)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print('SadTalker server listening on %s:%d' % (args.host, args.port))
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
@@ -1,8 +1,27 @@
+import os
 from tqdm import tqdm
 import torch
 from torch import nn
 
 
+# rough peak activation memory of the audio encoder for one (80, 16) mel window, in float32
+ENCODER_BYTES_PER_WINDOW = 2 * 1024**2
+
+def auto_micro_batch(device, bytes_per_item=ENCODER_BYTES_PER_WINDOW, fraction=0.25, min_size=16, max_size=4096):
+    """ number of items that fit in `fraction` of the free memory of `device` (VRAM on cuda, RAM otherwise) """
+    free = None
+    try:
+        if torch.device(device).type == 'cuda':
+            free = torch.cuda.mem_get_info(torch.device(device))[0]
+        else:
+            free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError, RuntimeError):
+        pass
+    if free is None:
+        return 256
+    return int(min(max(free * fraction // bytes_per_item, min_size), max_size))
+
+
 class Audio2Exp(nn.Module):
     def __init__(self, netG, cfg, device, prepare_training_loss=False):
         super(Audio2Exp, self).__init__()
@@ -10,32 +29,34 @@ class Audio2Exp(nn.Module):
         self.device = device
         self.netG = netG.to(device)
 
-    def test(self, batch):
+    def encode_audio(self, mel_input, micro_batch=None):
+        """ audio features of every mel window, (bs, T, 1, 80, 16) -> (bs*T, 512), `micro_batch` windows per forward """
+        audiox = mel_input.reshape(-1, 1, 80, 16)                  # bs*T 1 80 16
+        micro_batch = micro_batch or auto_micro_batch(audiox.device)
+        feats = []
+        for i in tqdm(range(0, audiox.shape[0], micro_batch), 'audio2exp:'):
+            feats.append(self.netG.encode(audiox[i:i+micro_batch]))
+        return torch.cat(feats, 0)
+
+    def test(self, batch, micro_batch=None):
 
         mel_input = batch['indiv_mels']                         # bs T 1 80 16
-        bs = mel_input.shape[0]
         T = mel_input.shape[1]
 
-        exp_coeff_pred = []
-
-        for i in tqdm(range(0, T, 10),'audio2exp:'): # every 10 frames
-            
-            current_mel_input = mel_input[:,i:i+10]
+        # the encoder is frame independent, so all windows are encoded in large micro batches
+        # and mapped to expressions in a single matmul
+        # features can be handed over by the caller, see Audio2Coeff.share_audio_encoder
+        audio_feat = batch.get('audio_feat')
+        if audio_feat is None:
+            audio_feat = self.encode_audio(mel_input, micro_batch)
+        audio_feat = audio_feat.reshape(-1, audio_feat.shape[-1])
+        ref = batch['ref'][:, :T, :64]                                      #bs T 64
+        ratio = batch['ratio_gt'][:, :T]                                    #bs T
 
-            #ref = batch['ref'][:, :, :64].repeat((1,current_mel_input.shape[1],1))           #bs T 64
-            ref = batch['ref'][:, :, :64][:, i:i+10]
-            ratio = batch['ratio_gt'][:, i:i+10]                               #bs T
-
-            audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
-
-            curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
-
-            exp_coeff_pred += [curr_exp_coeff_pred]
+        exp_coeff_pred = self.netG.decode(audio_feat, ref, ratio)          # bs T 64
 
         # BS x T x 64
         results_dict = {
-            'exp_coeff_pred': torch.cat(exp_coeff_pred, axis=1)
+            'exp_coeff_pred': exp_coeff_pred
             }
         return results_dict
-
-
@@ -64,11 +64,17 @@ class SimpleWrapperV2(nn.Module):
         #nn.init.constant_(self.mapping1.weight, 0.)
         nn.init.constant_(self.mapping1.bias, 0.)
 
-    def forward(self, x, ref, ratio):
-        x = self.audio_encoder(x).view(x.size(0), -1)
+    def encode(self, x):
+        """ (N, 1, 80, 16) mel windows -> (N, 512) audio features, every window is encoded independently """
+        return self.audio_encoder(x).view(x.size(0), -1)
+
+    def decode(self, x, ref, ratio):
         ref_reshape = ref.reshape(x.size(0), -1)
         ratio = ratio.reshape(x.size(0), -1)
         
         y = self.mapping1(torch.cat([x, ref_reshape, ratio], dim=1)) 
         out = y.reshape(ref.shape[0], ref.shape[1], -1) #+ ref # resudial
         return out
+
+    def forward(self, x, ref, ratio):
+        return self.decode(self.encode(x), ref, ratio)
@@ -3,6 +3,7 @@ from torch import nn
 from src.audio2pose_models.cvae import CVAE
 from src.audio2pose_models.discriminator import PoseSequenceDiscriminator
 from src.audio2pose_models.audio_encoder import AudioEncoder
+from src.audio2exp_models.audio2exp import auto_micro_batch
 
 class Audio2Pose(nn.Module):
     def __init__(self, cfg, wav2lip_checkpoint, device='cuda'):
@@ -45,12 +46,12 @@ class Audio2Pose(nn.Module):
 
         return batch
 
-    def test(self, x):
+    def test(self, x, generator=None):
+        """ All seq_len windows, plus the padded tail window, are decoded in one CVAE batch. 
+        `generator` (a seeded torch.Generator on the cpu) makes the sampled latent codes reproducible. """
 
         batch = {}
         ref = x['ref']                            #bs 1 70
-        batch['ref'] = x['ref'][:,0,-6:]  
-        batch['class'] = x['class']  
         bs = ref.shape[0]
         
         indiv_mels= x['indiv_mels']               # bs T 1 80 16
@@ -61,29 +62,38 @@ class Audio2Pose(nn.Module):
         #  
         div = num_frames//self.seq_len
         re = num_frames%self.seq_len
-        audio_emb_list = []
-        pose_motion_pred_list = [torch.zeros(batch['ref'].unsqueeze(1).shape, dtype=batch['ref'].dtype, 
-                                                device=batch['ref'].device)]
-
-        for i in range(div):
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len,:,:,:]) #bs seq_len 512
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'])  #list of bs seq_len 6
-        
-        if re != 0:
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, -1*self.seq_len:,:,:,:]) #bs seq_len  512
-            if audio_emb.shape[1] != self.seq_len:
-                pad_dim = self.seq_len-audio_emb.shape[1]
-                pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1) 
-                audio_emb = torch.cat([pad_audio_emb, audio_emb], 1) 
-            batch['audio_emb'] = audio_emb
+        num_windows = div + (re != 0)
+        pose_motion_pred_list = [torch.zeros(ref[:, :1, -6:].shape, dtype=ref.dtype, device=ref.device)]
+
+        if num_windows > 0:
+            # audio features of every frame, precomputed (see Audio2Coeff.share_audio_encoder) or encoded once
+            if x.get('audio_feat') is not None:
+                audio_emb = x['audio_feat'][:, 1:]
+            else:
+                micro_batch = auto_micro_batch(indiv_mels_use.device)
+                audio_emb = torch.cat([self.audio_encoder(indiv_mels_use[:, i:i+micro_batch])
+                                       for i in range(0, indiv_mels_use.shape[1], micro_batch)], 1)   #bs T 512
+
+            windows = audio_emb[:, :div*self.seq_len].reshape(bs, div, self.seq_len, audio_emb.shape[-1]).transpose(0, 1)   #div bs seq_len 512
+            if re != 0:
+                tail = audio_emb[:, -1*self.seq_len:]
+                if tail.shape[1] != self.seq_len:
+                    pad_dim = self.seq_len-tail.shape[1]
+                    tail = torch.cat([tail[:, :1].repeat(1, pad_dim, 1), tail], 1)
+                windows = torch.cat([windows, tail[None]], 0)
+
+            # one latent code per window and sample, drawn in the same order as window by window
+            z = torch.randn(num_windows, bs, self.latent_dim, generator=generator).to(ref.device)
+            batch['z'] = z.reshape(num_windows*bs, -1)
+            batch['audio_emb'] = windows.reshape(num_windows*bs, self.seq_len, -1)
+            batch['ref'] = ref[:, 0, -6:].repeat(num_windows, 1)
+            batch['class'] = x['class'].expand(bs).repeat(num_windows)
             batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'][:,-1*re:,:])   
+
+            pred = batch['pose_motion_pred'].reshape(num_windows, bs, self.seq_len, -1)
+            pose_motion_pred_list.append(pred[:div].transpose(0, 1).reshape(bs, div*self.seq_len, pred.shape[-1]))  #bs div*seq_len 6
+            if re != 0:
+                pose_motion_pred_list.append(pred[-1][:, -1*re:, :])
         
         pose_motion_pred = torch.cat(pose_motion_pred_list, dim = 1)
         batch['pose_motion_pred'] = pose_motion_pred
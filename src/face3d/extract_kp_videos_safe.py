@@ -15,6 +15,7 @@ from facexlib.detection import init_detection_model
 
 from facexlib.utils import load_file_from_url
 from src.face3d.util.my_awing_arch import FAN
+from src.utils.videoio import FrameSource
 
 def init_alignment_model(model_name, half=False, device='cuda', model_rootpath=None):
     if model_name == 'awing_fan':
@@ -31,8 +32,53 @@ def init_alignment_model(model_name, half=False, device='cuda', model_rootpath=N
     return model
 
 
+_face_models = {}
+
+def get_face_models(device='cuda', half=False, model_rootpath=None):
+    """ The FAN landmark and retinaface detection networks, loaded once per (device, precision) and process. """
+    key = (str(device), half, model_rootpath)
+    if key not in _face_models:
+        detector = init_alignment_model('awing_fan', device=device, model_rootpath=model_rootpath)
+        det_net = init_detection_model('retinaface_resnet50', half=half, device=device, model_rootpath=model_rootpath)
+        _face_models[key] = (detector, det_net)
+    return _face_models[key]
+
+def release_face_models():
+    _face_models.clear()
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def landmarks_box(keypoints):
+    return np.array([*keypoints.min(0), *keypoints.max(0)])
+
+def box_from_landmarks(keypoints, margins, image):
+    """ detection-like face box from 68 landmarks, clipped to the image """
+    lm_box = landmarks_box(keypoints)
+    size = np.array([lm_box[2] - lm_box[0], lm_box[3] - lm_box[1]] * 2)
+    box = lm_box + margins * size
+    w, h = image.size if isinstance(image, Image.Image) else image.shape[1::-1]
+    return [int(np.clip(box[0], 0, w - 1)), int(np.clip(box[1], 0, h - 1)), int(np.clip(box[2], 1, w)), int(np.clip(box[3], 1, h))]
+
+def box_iou(a, b):
+    iw = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    ih = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = iw * ih
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.
+
+
 class KeypointExtractor():
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', half=False):
 
         ### gfpgan/weights
         try:
@@ -42,27 +88,32 @@ class KeypointExtractor():
         except:
             root_path = 'gfpgan/weights'
 
-        self.detector = init_alignment_model('awing_fan',device=device, model_rootpath=root_path)   
-        self.det_net = init_detection_model('retinaface_resnet50', half=False,device=device, model_rootpath=root_path)
+        self.detector, self.det_net = get_face_models(device, half=half, model_rootpath=root_path)
 
-    def extract_keypoint(self, images, name=None, info=True):
-        if isinstance(images, list):
+    def extract_keypoint(self, images, name=None, info=True, batch_size=16, track=None):
+        if not isinstance(images, (np.ndarray, Image.Image)): # a list or a stream of images
             keypoints = []
             if info:
-                i_range = tqdm(images,desc='landmark Det:')
-            else:
-                i_range = images
-
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
-                # current_kp = self.detector.get_landmarks(np.array(image))
-                if np.mean(current_kp) == -1 and keypoints:
-                    keypoints.append(keypoints[-1])
+                pbar = tqdm(total=len(images) if hasattr(images, '__len__') else None, desc='landmark Det:')
+
+            for batch in iter_batches(images, batch_size):
+                if track is not None: # track-then-detect, pass a dict to keep the state between calls
+                    batch_kp = self.track_keypoint_batch(batch, track)
                 else:
-                    keypoints.append(current_kp[None])
+                    batch_kp = self.extract_keypoint_batch(batch)
+                for current_kp in batch_kp:
+                    if np.mean(current_kp) == -1 and keypoints:
+                        keypoints.append(keypoints[-1])
+                    else:
+                        keypoints.append(current_kp[None])
+                if info:
+                    pbar.update(len(batch))
 
+            if info:
+                pbar.close()
             keypoints = np.concatenate(keypoints, 0)
-            np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
+            if name is not None:
+                np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
             while True:
@@ -98,19 +149,93 @@ class KeypointExtractor():
                 np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
 
-def read_video(filename):
-    frames = []
-    cap = cv2.VideoCapture(filename)
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = Image.fromarray(frame)
-            frames.append(frame)
+    def detect_batch(self, images):
+        """ boxes of the faces in every image, with one detector forward when the images share a size """
+        sizes = set(image.size if isinstance(image, Image.Image) else image.shape for image in images)
+        if len(sizes) == 1 and hasattr(self.det_net, 'batched_detect_faces'):
+            if not isinstance(images[0], Image.Image):
+                # same as detect_faces, arrays are used as they are
+                images = torch.from_numpy(np.stack(images).astype(np.float32))
+            bboxes, _ = self.det_net.batched_detect_faces(images, 0.97)
+            return bboxes
+        return [self.det_net.detect_faces(image, 0.97) for image in images]
+
+    def landmarks_in_boxes(self, images, boxes):
+        """ 68 landmarks of the face in `boxes[i]` of every image, in image coordinates """
+        crops = [np.array(image)[box[1]:box[3], box[0]:box[2], :] for image, box in zip(images, boxes)]
+        landmarks = self.detector.get_landmarks_batch(crops)
+        keypoints = np.stack([landmark_98_to_68(landmark) for landmark in landmarks])
+        #### keypoints to the original location
+        keypoints += np.array([[box[:2]] for box in boxes])
+        return keypoints
+
+    def detect_keypoint_batch(self, images):
+        """ landmarks and detected box of the first face of every image, -1 and None where no face is found """
+        while True:
+            try:
+                with torch.no_grad():
+                    # face detection -> face alignment.
+                    bboxes = self.detect_batch(images)
+
+                    keypoints = -1. * np.ones([len(images), 68, 2])
+                    boxes = [[int(v) for v in b[0][:4]] if len(b) > 0 else None for b in bboxes]
+                    found = [idx for idx, box in enumerate(boxes) if box is not None]
+                    if found:
+                        keypoints[found] = self.landmarks_in_boxes([images[i] for i in found], [boxes[i] for i in found])
+                    return keypoints, boxes
+            except RuntimeError as e:
+                if str(e).startswith('CUDA'):
+                    print("Warning: out of memory, sleep for 1s")
+                    time.sleep(1)
+                else:
+                    raise
+
+    def extract_keypoint_batch(self, images):
+        """ 68 landmarks of the first face of every image, -1 where no face is found """
+        return self.detect_keypoint_batch(images)[0]
+
+    def track_keypoint_batch(self, images, track, keyframe_interval=50, min_iou=0.6):
+        """
+        Like extract_keypoint_batch, but retinaface only runs on keyframes. In between, the face box
+        is predicted from the landmarks of the latest frame, using the box/landmark margins measured
+        at the last detection. A frame whose new landmarks imply a box that drifted from the one it
+        was cropped with (IoU below `min_iou`) is detected again. `track` keeps the state between calls.
+        """
+        if track.get('box') is None or track['age'] >= keyframe_interval:
+            keypoints, boxes = self.detect_keypoint_batch(images)
+            redetect = []
         else:
-            break
-    cap.release()
-    return frames
+            box = track['box']
+            with torch.no_grad():
+                keypoints = self.landmarks_in_boxes(images, [box] * len(images))
+            redetect = [idx for idx in range(len(images))
+                        if box_iou(box, box_from_landmarks(keypoints[idx], track['margins'], images[idx])) < min_iou]
+            boxes = [None] * len(images)
+            if redetect:
+                keypoints[redetect], detected = self.detect_keypoint_batch([images[i] for i in redetect])
+                for idx, det_box in zip(redetect, detected):
+                    boxes[idx] = det_box
+            track['age'] += len(images)
+
+        for idx in range(len(images)):
+            if boxes[idx] is not None:
+                # calibrate the box predicted from the landmarks on detections
+                lm_box = landmarks_box(keypoints[idx])
+                size = np.array([lm_box[2] - lm_box[0], lm_box[3] - lm_box[1]] * 2, dtype=np.float64)
+                track['margins'] = (np.array(boxes[idx]) - lm_box) / np.maximum(size, 1)
+                track['age'] = len(images) - 1 - idx
+
+        valid = [idx for idx in range(len(images)) if np.mean(keypoints[idx]) != -1]
+        track['box'] = None
+        if valid and track.get('margins') is not None:
+            box = box_from_landmarks(keypoints[valid[-1]], track['margins'], images[valid[-1]])
+            if box[2] - box[0] >= 8 and box[3] - box[1] >= 8:
+                track['box'] = box
+        return keypoints
+
+def read_video(filename):
+    # lazily decoded, extract_keypoint consumes the frames one by one
+    return (Image.fromarray(frame) for frame in FrameSource(filename))
 
 def run(data):
     filename, opt, device = data
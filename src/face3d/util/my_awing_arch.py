@@ -20,18 +20,15 @@ def calculate_points(heatmaps):
     inr = indexes.ravel()
 
     heatline = heatline.reshape(B * N, HW)
-    x_up = heatline[BN_range, inr + 1]
+    x_up = heatline[BN_range, np.minimum(inr + 1, HW - 1)]
     x_down = heatline[BN_range, inr - 1]
     # y_up = heatline[BN_range, inr + W]
 
-    if any((inr + W) >= 4096):
-        y_up = heatline[BN_range, 4095]
-    else:
-        y_up = heatline[BN_range, inr + W]
-    if any((inr - W) <= 0):
-        y_down = heatline[BN_range, 0]
-    else:
-        y_down = heatline[BN_range, inr - W]
+    # the border fallback is decided per image, so batching does not change the result of a frame
+    up_border = np.repeat(((inr + W) >= HW).reshape(B, N).any(1), N)
+    down_border = np.repeat(((inr - W) <= 0).reshape(B, N).any(1), N)
+    y_up = np.where(up_border, heatline[:, HW - 1], heatline[BN_range, np.minimum(inr + W, HW - 1)])
+    y_down = np.where(down_border, heatline[:, 0], heatline[BN_range, np.maximum(inr - W, 0)])
 
     think_diff = np.sign(np.stack((x_up - x_down, y_up - y_down), axis=1))
     think_diff *= .25
@@ -376,3 +373,21 @@ class FAN(nn.Module):
         pred += offset[-2:]
 
         return pred
+
+    def get_landmarks_batch(self, imgs):
+        """ landmarks of a list of face crops (any size) with a single forward, (B, 98, 2) """
+        offsets = np.array([[img.shape[1] / 64, img.shape[0] / 64] for img in imgs])
+
+        inp = np.stack([cv2.resize(img, (256, 256))[..., ::-1] for img in imgs])
+        inp = torch.from_numpy(np.ascontiguousarray(inp.transpose((0, 3, 1, 2)))).float()
+        inp = inp.to(self.device)
+        inp.div_(255.0)
+
+        outputs, _ = self.forward(inp)
+        out = outputs[-1][:, :-1, :, :]
+        heatmaps = out.detach().cpu().numpy()
+
+        pred = calculate_points(heatmaps)
+        pred *= offsets[:, None, :]
+
+        return pred
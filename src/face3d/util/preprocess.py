@@ -70,6 +70,74 @@ def extract_5p(lm):
     lm5p = lm5p[[1, 2, 0, 3, 4], :]
     return lm5p
 
+def extract_5p_batch(lms):
+    lm_idx = np.array([31, 37, 40, 43, 46, 49, 55]) - 1
+    lm5p = np.stack([lms[:, lm_idx[0]], lms[:, lm_idx[[1, 2]]].mean(1), lms[:, lm_idx[[3, 4]]].mean(1),
+                     lms[:, lm_idx[5]], lms[:, lm_idx[6]]], axis=1)
+    return lm5p[:, [1, 2, 0, 3, 4]]
+
+def POS_batch(xp, x):
+    """
+    POS for N frames at once. The design matrix only depends on the 3d landmarks `x` (3, npts),
+    so the normal equations are solved once and applied to all 2d landmarks `xp` (N, 2, npts).
+    Returns t (N, 2) and s (N,).
+    """
+    B = np.concatenate([x.transpose(), np.ones([x.shape[1], 1])], 1)     # npts 4
+    pinv = np.linalg.solve(B.transpose() @ B, B.transpose())            # 4 npts
+    k = xp @ pinv.transpose()                                           # N 2 4
+
+    s = (np.linalg.norm(k[:, 0, :3], axis=1) + np.linalg.norm(k[:, 1, :3], axis=1))/2
+    t = k[:, :, 3]
+    return t, s
+
+# utils for face reconstruction
+def align_img_batch(imgs, lms, lm3D, target_size=224, rescale_factor=102.):
+    """
+    Batched align_img without the masks. Instead of resizing the whole frame and cropping it,
+    only the region of every frame that ends up in the crop is resized.
+
+    Return:
+        trans_params       --numpy.array  (N, 5) (raw_W, raw_H, scale, tx, ty)
+        imgs_new           --numpy.array  (N, target_size, target_size, 3), uint8
+        lms_new            --numpy.array  (N, 68, 2) or (N, 5, 2), y direction is opposite to v direction
+
+    Parameters:
+        imgs               --list of PIL.Image or numpy.array  (raw_H, raw_W, 3)
+        lms                --numpy.array  (N, 68, 2) or (N, 5, 2), y direction is opposite to v direction
+        lm3D               --numpy.array  (5, 3)
+    """
+    imgs = [np.asarray(img) for img in imgs]
+    size0 = np.array([[img.shape[1], img.shape[0]] for img in imgs], dtype=np.float64)   # N 2 (w0, h0)
+
+    lm5p = lms if lms.shape[1] == 5 else extract_5p_batch(lms)
+
+    # calculate translation and scale factors using 5 facial landmarks and standard landmarks of a 3D face
+    t, s = POS_batch(lm5p.transpose(0, 2, 1), lm3D.transpose())
+    s = rescale_factor/s
+
+    # same integer geometry as resize_n_crop_img
+    wh = (size0*s[:, None]).astype(np.int32)
+    left = (wh[:, 0]/2 - target_size/2 + (t[:, 0] - size0[:, 0]/2)*s).astype(np.int32)
+    up = (wh[:, 1]/2 - target_size/2 + (size0[:, 1]/2 - t[:, 1])*s).astype(np.int32)
+
+    imgs_new = []
+    for img, (w0, h0), (w, h), l, u in zip(imgs, size0, wh, left, up):
+        # only the part of the resized frame that falls inside the crop is resampled: with the box argument PIL
+        # uses the same filter, scale and edge clamping as resizing the whole frame, and crop pads the rest black
+        img_new = np.zeros((target_size, target_size, 3), dtype=np.uint8)
+        x0, y0, x1, y1 = max(l, 0), max(u, 0), min(l + target_size, w), min(u + target_size, h)
+        if x1 > x0 and y1 > y0:
+            box = (x0*w0/w, y0*h0/h, x1*w0/w, y1*h0/h)
+            region = Image.fromarray(img).resize((int(x1 - x0), int(y1 - y0)), resample=Image.BICUBIC, box=box)
+            img_new[y0 - u:y1 - u, x0 - l:x1 - l] = np.asarray(region.convert('RGB'))
+        imgs_new.append(img_new)
+
+    lms_new = (lms - t[:, None, :] + size0[:, None, :]/2)*s[:, None, None]
+    lms_new = lms_new - np.stack([wh[:, 0]/2 - target_size/2, wh[:, 1]/2 - target_size/2], 1)[:, None, :]
+
+    trans_params = np.concatenate([size0, s[:, None], t], 1)
+    return trans_params, np.stack(imgs_new), lms_new
+
 # utils for face reconstruction
 def align_img(img, lm, lm3D, mask=None, target_size=224., rescale_factor=102.):
     """
@@ -1,5 +1,7 @@
 import os
 import cv2
+import queue
+import threading
 import yaml
 import numpy as np
 import warnings
@@ -12,17 +14,20 @@ warnings.filterwarnings('ignore')
 import imageio
 import torch
 import torchvision
+from tqdm import tqdm
 
 
 from src.facerender.modules.keypoint_detector import HEEstimator, KPDetector
 from src.facerender.modules.mapping import MappingNet
 from src.facerender.modules.generator import OcclusionAwareGenerator, OcclusionAwareSPADEGenerator
-from src.facerender.modules.make_animation import make_animation 
+from src.facerender.modules.make_animation import make_animation, make_animation_batched, encode_source, render_frames
+from src.generate_facerender_batch import transform_semantic_target_batch
+from src.facerender.source_cache import SourceFeatureCache
 
-from pydub import AudioSegment 
-from src.utils.face_enhancer import enhancer_generator_with_len, enhancer_list
-from src.utils.paste_pic import paste_pic
-from src.utils.videoio import save_video_with_watermark
+from src.utils.face_enhancer import enhancer_stream
+from src.utils.paste_pic import paste_frames, load_full_img
+from src.utils.videoio import FFmpegVideoWriter, write_video
+from src.utils.safetensor_helper import load_x_from_safetensor, load_safetensor_checkpoint
 
 try:
     import webui  # in webui
@@ -80,6 +85,8 @@ class AnimateFromCoeff():
         self.generator.eval()
         self.he_estimator.eval()
         self.mapping.eval()
+
+        self.source_cache = SourceFeatureCache()
          
         self.device = device
     
@@ -87,26 +94,14 @@ class AnimateFromCoeff():
                         kp_detector=None, he_estimator=None,  
                         device="cpu"):
 
-        checkpoint = safetensors.torch.load_file(checkpoint_path)
+        checkpoint = load_safetensor_checkpoint(checkpoint_path)
 
         if generator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'generator' in k:
-                    x_generator[k.replace('generator.', '')] = v
-            generator.load_state_dict(x_generator)
+            generator.load_state_dict(load_x_from_safetensor(checkpoint, 'generator'))
         if kp_detector is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'kp_extractor' in k:
-                    x_generator[k.replace('kp_extractor.', '')] = v
-            kp_detector.load_state_dict(x_generator)
+            kp_detector.load_state_dict(load_x_from_safetensor(checkpoint, 'kp_extractor'))
         if he_estimator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'he_estimator' in k:
-                    x_generator[k.replace('he_estimator.', '')] = v
-            he_estimator.load_state_dict(x_generator)
+            he_estimator.load_state_dict(load_x_from_safetensor(checkpoint, 'he_estimator'))
         
         return None
 
@@ -154,7 +149,14 @@ class AnimateFromCoeff():
 
         return checkpoint['epoch']
 
-    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256):
+    def keep_aspect_ratio(self, result, crop_info, img_size):
+        ### the generated video is 256x256, so we keep the aspect ratio, 
+        original_size = crop_info[0]
+        if original_size:
+            result = [ cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) )) for result_i in result ]
+        return result
+
+    def render(self, x, crop_info, img_size=256, render_chunk_size=None):
 
         source_image=x['source_image'].type(torch.FloatTensor)
         source_semantics=x['source_semantics'].type(torch.FloatTensor)
@@ -180,9 +182,15 @@ class AnimateFromCoeff():
 
         frame_num = x['frame_num']
 
-        predictions_video = make_animation(source_image, source_semantics, target_semantics,
-                                        self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
-                                        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True)
+        if render_chunk_size:
+            predictions_video = make_animation_batched(source_image, source_semantics, target_semantics,
+                                            self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
+                                            yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True, chunk_size=render_chunk_size,
+                                            source_cache=self.source_cache)
+        else:
+            predictions_video = make_animation(source_image, source_semantics, target_semantics,
+                                            self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
+                                            yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True, source_cache=self.source_cache)
 
         predictions_video = predictions_video.reshape((-1,)+predictions_video.shape[2:])
         predictions_video = predictions_video[:frame_num]
@@ -194,65 +202,180 @@ class AnimateFromCoeff():
             video.append(image)
         result = img_as_ubyte(video)
 
-        ### the generated video is 256x256, so we keep the aspect ratio, 
-        original_size = crop_info[0]
-        if original_size:
-            result = [ cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) )) for result_i in result ]
-        
-        video_name = x['video_name']  + '.mp4'
-        path = os.path.join(video_save_dir, 'temp_'+video_name)
-        
-        # imageio.mimsave(path, result, format='FFMPEG')
-        imageio.mimsave(path, result,  fps=float(25))
+        return self.keep_aspect_ratio(result, crop_info, img_size)
+
+    def iter_frames(self, x, chunk_size, crop_info, img_size=256):
+        """ Render the clip `chunk_size` frames at a time. Target windows, predictions and output
+        frames only exist for the current chunk, so memory does not grow with the audio length. """
+
+        source_image = x['source_image'][:1].type(torch.FloatTensor).to(self.device)
+        source_semantics = x['source_semantics'][:1].type(torch.FloatTensor).to(self.device)
+        camera_seqs = {k: x[k].reshape(-1) for k in ['yaw_c_seq', 'pitch_c_seq', 'roll_c_seq'] if k in x}
+        target_3dmm = x['target_3dmm']
+        frame_num = x['frame_num']
+
+        source = encode_source(source_image, source_semantics, self.generator, self.kp_extractor, self.mapping, self.source_cache)
+
+        for start in tqdm(range(0, frame_num, chunk_size), 'Face Renderer:'):
+            frame_index = np.arange(start, min(start+chunk_size, frame_num))
+            target_semantics = transform_semantic_target_batch(target_3dmm, frame_index, x['semantic_radius'])
+            target_semantics = torch.FloatTensor(target_semantics).to(self.device)
+            cameras = {k: v[frame_index].type(torch.FloatTensor).to(self.device) for k, v in camera_seqs.items()}
+
+            predictions = render_frames(source, target_semantics, self.generator, self.mapping,
+                                        cameras.get('yaw_c_seq'), cameras.get('pitch_c_seq'), cameras.get('roll_c_seq'))
+            result = img_as_ubyte(predictions.permute(0, 2, 3, 1).cpu().numpy())
+            yield self.keep_aspect_ratio(list(result), crop_info, img_size)
+
+    def render_batch(self, xs, crop_infos, img_size=256, chunk_size=8):
+        """
+        Render several avatars driven by the same audio (get_facerender_data outputs with stream=True)
+        with their sources stacked along the generator batch: every pass renders `chunk_size` frames
+        of each avatar and yields the list of output frames of each avatar for these frames.
+        """
+        num_avatars = len(xs)
+        frame_num = xs[0]['frame_num']
+        source_image = torch.cat([x['source_image'][:1] for x in xs], 0).type(torch.FloatTensor).to(self.device)
+        source_semantics = torch.cat([x['source_semantics'][:1] for x in xs], 0).type(torch.FloatTensor).to(self.device)
+        camera_keys = [k for k in ['yaw_c_seq', 'pitch_c_seq', 'roll_c_seq'] if k in xs[0]]
+
+        source = encode_source(source_image, source_semantics, self.generator, self.kp_extractor, self.mapping, self.source_cache)
+
+        for start in tqdm(range(0, frame_num, chunk_size), 'Face Renderer:'):
+            frame_index = np.arange(start, min(start+chunk_size, frame_num))
+            # avatar-major: all frames of the first avatar, then of the second one ...
+            target_semantics = np.concatenate([transform_semantic_target_batch(x['target_3dmm'], frame_index, x['semantic_radius']) for x in xs], 0)
+            target_semantics = torch.FloatTensor(target_semantics).to(self.device)
+            cameras = {k: torch.cat([x[k].reshape(-1)[frame_index] for x in xs]).type(torch.FloatTensor).to(self.device) for k in camera_keys}
+            source_index = torch.arange(num_avatars, device=self.device).repeat_interleave(len(frame_index))
+
+            predictions = render_frames(source, target_semantics, self.generator, self.mapping,
+                                        cameras.get('yaw_c_seq'), cameras.get('pitch_c_seq'), cameras.get('roll_c_seq'), source_index)
+            result = img_as_ubyte(predictions.permute(0, 2, 3, 1).cpu().numpy()).reshape((num_avatars, len(frame_index))+predictions.shape[2:]+(3,))
+            yield [self.keep_aspect_ratio(list(frames), crop_info, img_size) for frames, crop_info in zip(result, crop_infos)]
+
+    def generate_batch(self, xs, video_save_dirs, pic_paths, crop_infos, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, render_chunk_size=8,
+                       max_avatars=4):
+        """
+        Animate several avatars driven by the same audio, `max_avatars` of them per render_batch pass.
+        The chunks are handed to one generate() pipeline per avatar (paste back, enhancer, ffmpeg) as
+        they are rendered, so only a few chunks per avatar are held in memory. Returns the video paths.
+        """
+        return_paths = []
+        for start in range(0, len(xs), max_avatars):
+            group = slice(start, start+max_avatars)
+            return_paths.extend(self._generate_group(xs[group], video_save_dirs[group], pic_paths[group], crop_infos[group],
+                                                     enhancer, background_enhancer, preprocess, img_size, render_chunk_size))
+        return return_paths
+
+    def _generate_group(self, xs, video_save_dirs, pic_paths, crop_infos, enhancer, background_enhancer, preprocess, img_size, render_chunk_size):
+        chunk_queues = [queue.Queue(maxsize=2) for _ in xs]
+        finished = [False for _ in xs]
+        return_paths = [None for _ in xs]
+        errors = []
+
+        def rendered(i):
+            while True:
+                chunk = chunk_queues[i].get()
+                if chunk is None:
+                    finished[i] = True
+                    return
+                for frame in chunk:
+                    yield frame
+
+        def output(i):
+            try:
+                return_paths[i] = self.generate(xs[i], video_save_dirs[i], pic_paths[i], crop_infos[i], enhancer=enhancer, background_enhancer=background_enhancer,
+                                                preprocess=preprocess, img_size=img_size, rendered=rendered(i))
+            except Exception as e:
+                errors.append(e)
+                # keep taking the chunks of this avatar, the renderer must not block on its queue
+                if not finished[i]:
+                    for _ in rendered(i):
+                        pass
+
+        threads = [threading.Thread(target=output, args=(i,), daemon=True) for i in range(len(xs))]
+        for thread in threads:
+            thread.start()
+        try:
+            for chunks in self.render_batch(xs, crop_infos, img_size, render_chunk_size):
+                for chunk_queue, chunk in zip(chunk_queues, chunks):
+                    chunk_queue.put(chunk)
+        finally:
+            for chunk_queue in chunk_queues:
+                chunk_queue.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return return_paths
+
+    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, render_chunk_size=None, stream_chunk=None,
+                 rendered=None):
 
+        frame_num = x['frame_num']
+        video_name = x['video_name']  + '.mp4'
         av_path = os.path.join(video_save_dir, video_name)
         return_path = av_path 
-        
-        audio_path =  x['audio_path'] 
-        audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
-        new_audio_path = os.path.join(video_save_dir, audio_name+'.wav')
-        start_time = 0
-        # cog will not keep the .mp3 filename
-        sound = AudioSegment.from_file(audio_path)
-        frames = frame_num 
-        end_time = start_time + frames*1/25*1000
-        word1=sound.set_frame_rate(16000)
-        word = word1[start_time:end_time]
-        word.export(new_audio_path, format="wav")
-
-        save_video_with_watermark(path, new_audio_path, av_path, watermark= False)
-        print(f'The generated video is named {video_save_dir}/{video_name}') 
 
-        if 'full' in preprocess.lower():
+        # cog will not keep the .mp3 filename, ffmpeg reads the audio as it is and cuts it to the video length
+        audio_path =  x['audio_path'] 
+        duration = frame_num/25.
+        
+        # `rendered` frames can be handed over, e.g. by generate_batch
+        if rendered is None and stream_chunk:
+            rendered = (frame for chunk in self.iter_frames(x, stream_chunk, crop_info, img_size) for frame in chunk)
+        elif rendered is None:
+            rendered = self.render(x, crop_info, img_size, render_chunk_size)
+
+        full = 'full' in preprocess.lower()
+        if full:
             # only add watermark to the full image.
             video_name_full = x['video_name']  + '_full.mp4'
             full_video_path = os.path.join(video_save_dir, video_name_full)
             return_path = full_video_path
-            paste_pic(path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop= True if 'ext' in preprocess.lower() else False)
-            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
         else:
             full_video_path = av_path 
 
+        def output_frames():
+            """ Write the crop (and full) video while yielding the final frames downstream. """
+            with FFmpegVideoWriter(av_path, audio_path, duration) as writer:
+                def write_rendered():
+                    for frame in rendered:
+                        writer.write(frame)
+                        yield frame
+
+                if full and len(crop_info) == 3:
+                    # paste the rendered crops straight back, the crop video is never decoded again
+                    full_img = cv2.cvtColor(load_full_img(pic_path), cv2.COLOR_BGR2RGB)
+                    extended_crop = 'ext' in preprocess.lower()
+                    with FFmpegVideoWriter(full_video_path, audio_path, duration) as full_writer:
+                        for frame in tqdm(paste_frames(write_rendered(), full_img, crop_info, extended_crop), 'seamlessClone:', total=frame_num):
+                            full_writer.write(frame)
+                            yield frame
+                else:
+                    if full:
+                        print("you didn't crop the image")
+                    for frame in write_rendered():
+                        yield frame
+
         #### paste back then enhancers
         if enhancer:
             video_name_enhancer = x['video_name']  + '_enhanced.mp4'
-            enhanced_path = os.path.join(video_save_dir, 'temp_'+video_name_enhancer)
             av_path_enhancer = os.path.join(video_save_dir, video_name_enhancer) 
             return_path = av_path_enhancer
 
-            try:
-                enhanced_images_gen_with_len = enhancer_generator_with_len(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            except:
-                enhanced_images_gen_with_len = enhancer_list(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            
-            save_video_with_watermark(enhanced_path, new_audio_path, av_path_enhancer, watermark= False)
-            print(f'The generated video is named {video_save_dir}/{video_name_enhancer}')
-            os.remove(enhanced_path)
+            # rendering/pasting runs in the enhancer's producer thread, encoding overlaps in ffmpeg
+            enhanced_images = enhancer_stream(output_frames(), method=enhancer, bg_upsampler=background_enhancer)
+            write_video(av_path_enhancer, tqdm(enhanced_images, 'Face Enhancer:', total=frame_num), audio_path, duration)
+        else:
+            for _ in output_frames():
+                pass
 
-        os.remove(path)
-        os.remove(new_audio_path)
+        print(f'The generated video is named {video_save_dir}/{video_name}') 
+        if full:
+            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
+        if enhancer:
+            print(f'The generated video is named {video_save_dir}/{video_name_enhancer}')
 
         return return_path
-
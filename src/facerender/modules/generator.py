@@ -67,8 +67,8 @@ class OcclusionAwareGenerator(nn.Module):
             deformation = deformation.permute(0, 2, 3, 4, 1)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        # Encoding (downsampling) part, only depends on the source image
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -76,7 +76,19 @@ class OcclusionAwareGenerator(nn.Module):
         bs, c, h, w = out.shape
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
+        if self.dense_motion_network is None:
+            # without the dense motion the decoder takes the features from before the 3d resblocks
+            return feature_3d
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.decode(feature_3d, kp_driving, kp_source)
+
+    def decode(self, feature_3d, kp_driving, kp_source):
+        bs, c, d, h, w = feature_3d.shape
+        out = feature_3d.view(bs, c*d, h, w)
 
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
@@ -207,8 +219,8 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             deformation = deformation.permute(0, 2, 3, 4, 1)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        # Encoding (downsampling) part, only depends on the source image
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -216,7 +228,19 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         bs, c, h, w = out.shape
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
+        if self.dense_motion_network is None:
+            # without the dense motion the decoder takes the features from before the 3d resblocks
+            return feature_3d
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.decode(feature_3d, kp_driving, kp_source)
+
+    def decode(self, feature_3d, kp_driving, kp_source):
+        bs, c, d, h, w = feature_3d.shape
+        out = feature_3d.view(bs, c*d, h, w)
 
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
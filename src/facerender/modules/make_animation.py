@@ -99,16 +99,65 @@ def keypoint_transformation(kp_canonical, he, wo_exp=False):
 
 
 
+def encode_source(source_image, source_semantics, generator, kp_detector, mapping, source_cache=None):
+    """
+    Everything the renderer needs from the source image, computed once per clip.
+    With a SourceFeatureCache the result is reused across requests of the same avatar.
+    """
+    if source_cache is not None:
+        key = source_cache.make_key(source_image, source_semantics)
+        source = source_cache.get(key)
+        if source is not None:
+            return source
+
+    with torch.no_grad():
+        kp_canonical = kp_detector(source_image)
+        he_source = mapping(source_semantics)
+        kp_source = keypoint_transformation(kp_canonical, he_source)
+        feature_3d = generator.encode_source(source_image)
+
+    source = {'feature_3d': feature_3d, 'kp_canonical': kp_canonical, 'kp_source': kp_source}
+    if source_cache is not None:
+        source_cache.put(key, source)
+    return source
+
+def driving_keypoints(kp_canonical, target_semantics, mapping, yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None):
+    """ driving keypoints of a flat batch of frames: kp_canonical N k 3, target_semantics N 70 27 """
+    he_driving = mapping(target_semantics)
+    if yaw_c_seq is not None:
+        he_driving['yaw_in'] = yaw_c_seq.reshape(-1)
+    if pitch_c_seq is not None:
+        he_driving['pitch_in'] = pitch_c_seq.reshape(-1)
+    if roll_c_seq is not None:
+        he_driving['roll_in'] = roll_c_seq.reshape(-1)
+    return keypoint_transformation({'value': kp_canonical}, he_driving)['value']
+
+def render_frames(source, target_semantics, generator, mapping, yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, source_index=None):
+    """ render N frames of an encoded source (see encode_source): target_semantics N 70 27 -> N 3 H W.
+    With several sources encoded together, `source_index` (N,) picks the source of every frame. """
+    with torch.no_grad():
+        frame_num = target_semantics.shape[0]
+        if source_index is None:
+            pick = lambda t: t.expand((frame_num,)+t.shape[1:])
+        else:
+            pick = lambda t: t[source_index]
+        kp_canonical = pick(source['kp_canonical']['value'])
+        kp_driving = driving_keypoints(kp_canonical, target_semantics, mapping, yaw_c_seq, pitch_c_seq, roll_c_seq)
+        out = generator.decode(pick(source['feature_3d']),
+                               kp_source={'value': pick(source['kp_source']['value'])},
+                               kp_driving={'value': kp_driving})
+    return out['prediction']
+
 def make_animation(source_image, source_semantics, target_semantics,
                             generator, kp_detector, he_estimator, mapping, 
                             yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
-                            use_exp=True, use_half=False):
+                            use_exp=True, use_half=False, source_cache=None):
     with torch.no_grad():
         predictions = []
 
-        kp_canonical = kp_detector(source_image)
-        he_source = mapping(source_semantics)
-        kp_source = keypoint_transformation(kp_canonical, he_source)
+        source = encode_source(source_image, source_semantics, generator, kp_detector, mapping, source_cache)
+        kp_canonical = source['kp_canonical']
+        kp_source = source['kp_source']
     
         for frame_idx in tqdm(range(target_semantics.shape[1]), 'Face Renderer:'):
             # still check the dimension
@@ -125,7 +174,7 @@ def make_animation(source_image, source_semantics, target_semantics,
             kp_driving = keypoint_transformation(kp_canonical, he_driving)
                 
             kp_norm = kp_driving
-            out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
+            out = generator.decode(source['feature_3d'], kp_source=kp_source, kp_driving=kp_norm)
             '''
             source_image_new = out['prediction'].squeeze(1)
             kp_canonical_new =  kp_detector(source_image_new)
@@ -138,6 +187,40 @@ def make_animation(source_image, source_semantics, target_semantics,
         predictions_ts = torch.stack(predictions, dim=1)
     return predictions_ts
 
+def make_animation_batched(source_image, source_semantics, target_semantics,
+                            generator, kp_detector, he_estimator, mapping, 
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
+                            use_exp=True, use_half=False, chunk_size=16, source_cache=None):
+    """
+    Same output as make_animation, but the mapping network and the keypoint
+    transformation run once over the whole target sequence, and the generator
+    renders `chunk_size` frames per forward pass instead of one frame index at a time.
+    """
+    with torch.no_grad():
+        bs, frame_num = target_semantics.shape[:2]
+
+        source = encode_source(source_image, source_semantics, generator, kp_detector, mapping, source_cache)
+        kp_canonical = source['kp_canonical']
+        kp_source = source['kp_source']
+
+        # bs T 70 27 -> bs*T 70 27, keeps the frame order of the clip
+        kp_driving = driving_keypoints(kp_canonical['value'].repeat_interleave(frame_num, dim=0),
+                                       target_semantics.reshape((-1,)+target_semantics.shape[2:]), mapping,
+                                       yaw_c_seq, pitch_c_seq, roll_c_seq)    # bs*T k 3
+        kp_source_seq = kp_source['value'].repeat_interleave(frame_num, dim=0)      # bs*T k 3
+        source_index = torch.arange(bs, device=source_image.device).repeat_interleave(frame_num)
+
+        predictions = []
+        for start in tqdm(range(0, bs*frame_num, chunk_size), 'Face Renderer:'):
+            end = min(start+chunk_size, bs*frame_num)
+            out = generator.decode(source['feature_3d'][source_index[start:end]],
+                            kp_source={'value': kp_source_seq[start:end]},
+                            kp_driving={'value': kp_driving[start:end]})
+            predictions.append(out['prediction'])
+        predictions_ts = torch.cat(predictions, dim=0)
+        predictions_ts = predictions_ts.reshape((bs, frame_num)+predictions_ts.shape[1:])
+    return predictions_ts
+
 class AnimateModel(torch.nn.Module):
     """
     Merge all generator related updates into single model for better multi-gpu usage
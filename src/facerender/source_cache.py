@@ -0,0 +1,41 @@
+import hashlib
+from collections import OrderedDict
+
+
+class SourceFeatureCache():
+    """
+    LRU cache for the encoded source of the face renderer (3d feature volume, canonical and
+    source keypoints). Entries are keyed by the content hash and the size of the source image
+    and source semantics, so repeated avatars skip the generator encoder entirely.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(source_image, source_semantics):
+        sha = hashlib.sha1()
+        for tensor in (source_image, source_semantics):
+            tensor = tensor.detach().cpu().contiguous()
+            sha.update(str(tuple(tensor.shape)).encode())
+            sha.update(tensor.numpy().tobytes())
+        return sha.hexdigest()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
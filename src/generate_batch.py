@@ -1,11 +1,10 @@
 import os
 
-from tqdm import tqdm
 import torch
 import numpy as np
 import random
-import scipy.io as scio
 import src.utils.audio as audio
+from src.utils.coeff_io import load_coeffs
 
 def crop_pad_audio(wav, audio_length):
     if len(wav) > audio_length:
@@ -48,45 +47,66 @@ def generate_blink_seq_randomly(num_frames):
             break
     return ratio
 
-def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True):
+def get_indiv_mels(orig_mel, num_frames, fps=25, syncnet_mel_step_size=16, start_frame=0):
+    """ the mel window of every video frame, gathered with one index array: T 80 16 """
+    frame_ids = np.arange(start_frame, start_frame+num_frames)
+    start_idx = (80. * ((frame_ids - 2) / float(fps))).astype(np.int64)       # truncates like int()
+    seq = start_idx[:, None] + np.arange(syncnet_mel_step_size)[None]
+    seq = np.clip(seq, 0, orig_mel.shape[0]-1)
+    return orig_mel[seq].transpose(0, 2, 1)
+
+def load_audio(audio_path, audio_cache=None, fps=25):
+    """ the normalized mel spectrogram of the audio and its number of video frames, shared by every get_data call on it """
+    audio_key = None
+    if audio_cache is not None:
+        audio_key = audio_cache.make_key(audio_path, 16000, fps)
+        cached = audio_cache.get(audio_key)
+        if cached is not None:
+            return dict(cached, audio_key=audio_key)
+
+    wav = audio.load_wav(audio_path, 16000) 
+    wav_length, num_frames = parse_audio_length(len(wav), 16000, fps)
+    wav = crop_pad_audio(wav, wav_length)
+    orig_mel = audio.melspectrogram(wav).T         # nframes 80
+    if audio_cache is not None:
+        audio_cache.put(audio_key, orig_mel, num_frames)
+    return {'orig_mel': orig_mel, 'num_frames': num_frames, 'audio_key': audio_key}
+
+def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True, lazy_mels=False,
+             audio_cache=None, audio_data=None):
 
     syncnet_mel_step_size = 16
     fps = 25
 
-    pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
+    if isinstance(first_coeff_path, dict): # coeffs of CropAndExtract.extract
+        pic_name = first_coeff_path['pic_name']
+    else:
+        pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
     audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
 
-    
+    audio_key = None
     if idlemode:
         num_frames = int(length_of_audio * 25)
-        indiv_mels = np.zeros((num_frames, 80, 16))
+        orig_mel = None
+        if not lazy_mels:
+            indiv_mels = np.zeros((num_frames, 80, 16))
     else:
-        wav = audio.load_wav(audio_path, 16000) 
-        wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
-        wav = crop_pad_audio(wav, wav_length)
-        orig_mel = audio.melspectrogram(wav).T
-        spec = orig_mel.copy()         # nframes 80
-        indiv_mels = []
-
-        for i in tqdm(range(num_frames), 'mel:'):
-            start_frame_num = i-2
-            start_idx = int(80. * (start_frame_num / float(fps)))
-            end_idx = start_idx + syncnet_mel_step_size
-            seq = list(range(start_idx, end_idx))
-            seq = [ min(max(item, 0), orig_mel.shape[0]-1) for item in seq ]
-            m = spec[seq, :]
-            indiv_mels.append(m.T)
-        indiv_mels = np.asarray(indiv_mels)         # T 80 16
+        # `audio_data` of load_audio can be handed over when the same audio drives several avatars
+        if audio_data is None:
+            audio_data = load_audio(audio_path, audio_cache, fps)
+        orig_mel, num_frames, audio_key = audio_data['orig_mel'], audio_data['num_frames'], audio_data['audio_key']
+        if not lazy_mels:
+            indiv_mels = get_indiv_mels(orig_mel, num_frames, fps, syncnet_mel_step_size)         # T 80 16
 
     ratio = generate_blink_seq_randomly(num_frames)      # T
     source_semantics_path = first_coeff_path
-    source_semantics_dict = scio.loadmat(source_semantics_path)
+    source_semantics_dict = load_coeffs(source_semantics_path)
     ref_coeff = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
     ref_coeff = np.repeat(ref_coeff, num_frames, axis=0)
 
     if ref_eyeblink_coeff_path is not None:
         ratio[:num_frames] = 0
-        refeyeblink_coeff_dict = scio.loadmat(ref_eyeblink_coeff_path)
+        refeyeblink_coeff_dict = load_coeffs(ref_eyeblink_coeff_path)
         refeyeblink_coeff = refeyeblink_coeff_dict['coeff_3dmm'][:,:64]
         refeyeblink_num_frames = refeyeblink_coeff.shape[0]
         if refeyeblink_num_frames<num_frames:
@@ -99,8 +119,6 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
 
         ref_coeff[:, :64] = refeyeblink_coeff[:num_frames, :64] 
     
-    indiv_mels = torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0) # bs T 1 80 16
-
     if use_blink:
         ratio = torch.FloatTensor(ratio).unsqueeze(0)                       # bs T
     else:
@@ -108,13 +126,31 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
                                # bs T
     ref_coeff = torch.FloatTensor(ref_coeff).unsqueeze(0)                # bs 1 70
 
-    indiv_mels = indiv_mels.to(device)
     ratio = ratio.to(device)
     ref_coeff = ref_coeff.to(device)
 
-    return {'indiv_mels': indiv_mels,  
-            'ref': ref_coeff, 
-            'num_frames': num_frames, 
-            'ratio_gt': ratio,
-            'audio_name': audio_name, 'pic_name': pic_name}
+    batch = {'ref': ref_coeff, 
+             'num_frames': num_frames, 
+             'ratio_gt': ratio,
+             'audio_name': audio_name, 'pic_name': pic_name,
+             'audio_key': audio_key}
+
+    if lazy_mels:
+        # the windows are cut per chunk by Audio2Coeff, see get_mel_chunk
+        batch['orig_mel'] = orig_mel
+    else:
+        indiv_mels = torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0) # bs T 1 80 16
+        batch['indiv_mels'] = indiv_mels.to(device)
+
+    return batch
+
+def get_mel_chunk(batch, start, end, device):
+    """ indiv_mels of the frames [start, end): bs T 1 80 16 """
+    if 'indiv_mels' in batch:
+        return batch['indiv_mels'][:, start:end]
+    if batch['orig_mel'] is None:
+        indiv_mels = np.zeros((end-start, 80, 16))
+    else:
+        indiv_mels = get_indiv_mels(batch['orig_mel'], end-start, start_frame=start)
+    return torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0).to(device)
 
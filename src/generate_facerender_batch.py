@@ -3,37 +3,45 @@ import numpy as np
 from PIL import Image
 from skimage import io, img_as_float32, transform
 import torch
-import scipy.io as scio
+from src.utils.coeff_io import load_coeffs, dump_coeffs_txt
 
 def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
                         batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
-                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256):
+                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256, stream=False, dump_txt=False):
 
     semantic_radius = 13
-    video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
-    txt_path = os.path.splitext(coeff_path)[0]
+    if isinstance(coeff_path, dict): # coeffs of Audio2Coeff.predict
+        video_name = coeff_path['video_name']
+        # the text dump goes next to the saved coefficients, if they were saved
+        dump_txt = dump_txt and 'coeff_path' in coeff_path
+        if dump_txt:
+            txt_path = os.path.splitext(coeff_path['coeff_path'])[0]
+    else:
+        video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
+        txt_path = os.path.splitext(coeff_path)[0]
 
     data={}
 
-    img1 = Image.open(pic_path)
-    source_image = np.array(img1)
+    # the cropped picture, or the RGB array of CropAndExtract.extract
+    source_image = pic_path if isinstance(pic_path, np.ndarray) else np.array(Image.open(pic_path))
     source_image = img_as_float32(source_image)
-    source_image = transform.resize(source_image, (size, size, 3))
+    if source_image.shape != (size, size, 3):
+        source_image = transform.resize(source_image, (size, size, 3))
     source_image = source_image.transpose((2, 0, 1))
     source_image_ts = torch.FloatTensor(source_image).unsqueeze(0)
     source_image_ts = source_image_ts.repeat(batch_size, 1, 1, 1)
     data['source_image'] = source_image_ts
  
-    source_semantics_dict = scio.loadmat(first_coeff_path)
-    generated_dict = scio.loadmat(coeff_path)
+    source_semantics_dict = load_coeffs(first_coeff_path)
+    generated_dict = load_coeffs(coeff_path)
 
     if 'full' not in preprocess.lower():
         source_semantics = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
+        generated_3dmm = generated_dict['coeff_3dmm'][:,:70].copy()
 
     else:
         source_semantics = source_semantics_dict['coeff_3dmm'][:1,:73]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
+        generated_3dmm = generated_dict['coeff_3dmm'][:,:70].copy()
 
     source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
     source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
@@ -49,27 +57,24 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
     if still_mode:
         generated_3dmm[:, 64:] = np.repeat(source_semantics[:, 64:], generated_3dmm.shape[0], axis=0)
 
-    with open(txt_path+'.txt', 'w') as f:
-        for coeff in generated_3dmm:
-            for i in coeff:
-                f.write(str(i)[:7]   + '  '+'\t')
-            f.write('\n')
+    if dump_txt:
+        dump_coeffs_txt(txt_path+'.txt', generated_3dmm)
 
-    target_semantics_list = [] 
     frame_num = generated_3dmm.shape[0]
     data['frame_num'] = frame_num
-    for frame_idx in range(frame_num):
-        target_semantics = transform_semantic_target(generated_3dmm, frame_idx, semantic_radius)
-        target_semantics_list.append(target_semantics)
+    data['target_3dmm'] = generated_3dmm
+    data['semantic_radius'] = semantic_radius
 
-    remainder = frame_num%batch_size
-    if remainder!=0:
-        for _ in range(batch_size-remainder):
-            target_semantics_list.append(target_semantics)
+    # in stream mode the renderer builds the target windows chunk by chunk from target_3dmm
+    if not stream:
+        frame_index = np.arange(frame_num)
+        remainder = frame_num%batch_size
+        if remainder!=0:
+            frame_index = np.concatenate([frame_index, np.repeat(frame_index[-1:], batch_size-remainder)])
 
-    target_semantics_np = np.array(target_semantics_list)             #frame_num 70 semantic_radius*2+1
-    target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
-    data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
+        target_semantics_np = transform_semantic_target_batch(generated_3dmm, frame_index, semantic_radius)             #frame_num 70 semantic_radius*2+1
+        target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
+        data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
     data['video_name'] = video_name
     data['audio_path'] = audio_path
     
@@ -97,6 +102,13 @@ def transform_semantic_target(coeff_3dmm, frame_index, semantic_radius):
     coeff_3dmm_g = coeff_3dmm[index, :]
     return coeff_3dmm_g.transpose(1,0)
 
+def transform_semantic_target_batch(coeff_3dmm, frame_index, semantic_radius):
+    """ transform_semantic_target for many frames at once: len(frame_index) 70 semantic_radius*2+1 """
+    num_frames = coeff_3dmm.shape[0]
+    index = np.asarray(frame_index)[:, None] + np.arange(-semantic_radius, semantic_radius+1)[None]
+    index = np.clip(index, 0, num_frames-1)
+    return coeff_3dmm[index].transpose(0, 2, 1)
+
 def gen_camera_pose(camera_degree_list, frame_num, batch_size):
 
     new_degree_list = [] 
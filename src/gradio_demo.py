@@ -7,6 +7,10 @@ from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 
 from src.utils.init_path import init_path
+from src.utils.safetensor_helper import release_safetensor_checkpoint
+from src.utils.face_enhancer import release_restorers
+from src.face3d.extract_kp_videos_safe import release_face_models
+from src.utils.preprocess_cache import PreprocessCache, AudioFeatureCache
 
 from pydub import AudioSegment
 
@@ -18,7 +22,7 @@ def mp3_to_wav(mp3_filename,wav_filename,frame_rate):
 
 class SadTalker():
 
-    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', lazy_load=False):
+    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', lazy_load=False, keep_models=False, preprocess_cache_dir=None, audio_cache_dir=None):
 
         if torch.cuda.is_available() :
             device = "cuda"
@@ -31,6 +35,42 @@ class SadTalker():
 
         self.checkpoint_path = checkpoint_path
         self.config_path = config_path
+
+        # models stay resident between calls, one set per (size, preprocess) variant
+        self.keep_models = keep_models
+        self.models = {}
+        self.preprocess_cache = PreprocessCache(preprocess_cache_dir) if preprocess_cache_dir else None
+        self.audio_cache = AudioFeatureCache(audio_cache_dir) if audio_cache_dir else None
+
+    def load_models(self, size=256, preprocess='crop'):
+        key = (size, preprocess)
+        if key in self.models:
+            return self.models[key]
+
+        sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
+        print(sadtalker_paths)
+
+        models = {
+            'sadtalker_paths': sadtalker_paths,
+            'audio_to_coeff': Audio2Coeff(sadtalker_paths, self.device, self.audio_cache),
+            'preprocess_model': CropAndExtract(sadtalker_paths, self.device, self.preprocess_cache),
+            'animate_from_coeff': AnimateFromCoeff(sadtalker_paths, self.device),
+        }
+        if self.keep_models:
+            self.models[key] = models
+        return models
+
+    def unload_models(self):
+        self.models = {}
+        release_safetensor_checkpoint()
+        release_restorers()
+        release_face_models()
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
+
+        import gc; gc.collect()
       
 
     def test(self, source_image, driven_audio, preprocess='crop', 
@@ -43,12 +83,11 @@ class SadTalker():
         length_of_audio = 0, use_blink=True,
         result_dir='./results/'):
 
-        self.sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
-        print(self.sadtalker_paths)
-            
-        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
-        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
-        self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
+        models = self.load_models(size, preprocess)
+        self.sadtalker_paths = models['sadtalker_paths']
+        self.audio_to_coeff = models['audio_to_coeff']
+        self.preprocess_model = models['preprocess_model']
+        self.animate_from_coeff = models['animate_from_coeff']
 
         time_tag = str(uuid.uuid4())
         save_dir = os.path.join(result_dir, time_tag)
@@ -90,52 +129,48 @@ class SadTalker():
 
         os.makedirs(save_dir, exist_ok=True)
         
-        #crop image and extract 3dmm from image
-        first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
-        os.makedirs(first_frame_dir, exist_ok=True)
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
+        #crop image and extract 3dmm from image, the stages hand their arrays over in memory
+        first_coeff = self.preprocess_model.extract(pic_path, preprocess, True, size)
         
-        if first_coeff_path is None:
+        if first_coeff is None:
             raise AttributeError("No face is detected")
+        crop_info = first_coeff['crop_info']
 
         if use_ref_video:
             print('using ref video for genreation')
-            ref_video_videoname = os.path.splitext(os.path.split(ref_video)[-1])[0]
-            ref_video_frame_dir = os.path.join(save_dir, ref_video_videoname)
-            os.makedirs(ref_video_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_video_coeff_path, _, _ =  self.preprocess_model.generate(ref_video, ref_video_frame_dir, preprocess, source_image_flag=False)
+            ref_video_coeff = self.preprocess_model.extract(ref_video, preprocess, source_image_flag=False)
         else:
-            ref_video_coeff_path = None
+            ref_video_coeff = None
 
         if use_ref_video:
             if ref_info == 'pose':
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = None
+                ref_pose_coeff = ref_video_coeff
+                ref_eyeblink_coeff = None
             elif ref_info == 'blink':
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = ref_video_coeff_path
+                ref_pose_coeff = None
+                ref_eyeblink_coeff = ref_video_coeff
             elif ref_info == 'pose+blink':
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = ref_video_coeff_path
+                ref_pose_coeff = ref_video_coeff
+                ref_eyeblink_coeff = ref_video_coeff
             elif ref_info == 'all':            
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = None
+                ref_pose_coeff = None
+                ref_eyeblink_coeff = None
             else:
                 raise('error in refinfo')
         else:
-            ref_pose_coeff_path = None
-            ref_eyeblink_coeff_path = None
+            ref_pose_coeff = None
+            ref_eyeblink_coeff = None
 
         #audio2ceoff
         if use_ref_video and ref_info == 'all':
-            coeff_path = ref_video_coeff_path # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            coeff = dict(ref_video_coeff, video_name=ref_video_coeff['pic_name']) # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
         else:
-            batch = get_data(first_coeff_path, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff_path, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
-            coeff_path = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            batch = get_data(first_coeff, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink, audio_cache=self.audio_cache) # longer audio?
+            coeff = self.audio_to_coeff.predict(batch, pose_style, ref_pose_coeff)
 
         #coeff2video
-        data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
+        data = get_facerender_data(coeff, first_coeff['crop_pic'], first_coeff, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
         return_path = self.animate_from_coeff.generate(data, save_dir,  pic_path, crop_info, enhancer='gfpgan' if use_enhancer else None, preprocess=preprocess, img_size=size)
         video_name = data['video_name']
         print(f'The generated video is named {video_name} in {save_dir}')
@@ -143,12 +178,10 @@ class SadTalker():
         del self.preprocess_model
         del self.audio_to_coeff
         del self.animate_from_coeff
+        del models
 
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            
-        import gc; gc.collect()
+        if not self.keep_models:
+            self.unload_models()
         
         return return_path
 
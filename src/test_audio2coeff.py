@@ -1,7 +1,9 @@
 import os 
+import hashlib
 import torch
 import numpy as np
-from scipy.io import savemat, loadmat
+from tqdm import tqdm
+from src.utils.coeff_io import save_coeffs, load_coeffs
 from yacs.config import CfgNode as CN
 from scipy.signal import savgol_filter
 
@@ -10,8 +12,22 @@ import safetensors.torch
 
 from src.audio2pose_models.audio2pose import Audio2Pose
 from src.audio2exp_models.networks import SimpleWrapperV2 
-from src.audio2exp_models.audio2exp import Audio2Exp
-from src.utils.safetensor_helper import load_x_from_safetensor  
+from src.audio2exp_models.audio2exp import Audio2Exp, auto_micro_batch
+from src.utils.safetensor_helper import load_x_from_safetensor, load_safetensor_checkpoint
+from src.generate_batch import get_mel_chunk
+
+def same_weights(module_a, module_b):
+    """ True when two modules hold identical parameters and buffers, e.g. the BatchNorm statistics """
+    state_a, state_b = module_a.state_dict(), module_b.state_dict()
+    return state_a.keys() == state_b.keys() and all(
+        state_a[k].shape == state_b[k].shape and torch.equal(state_a[k], state_b[k].to(state_a[k].device)) for k in state_a)
+
+def weights_sha1(module):
+    sha = hashlib.sha1()
+    for k, v in module.state_dict().items():
+        sha.update(k.encode())
+        sha.update(v.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
 
 def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
     checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
@@ -24,7 +40,7 @@ def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
 
 class Audio2Coeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, audio_cache=None):
         #load config
         fcfg_pose = open(sadtalker_path['audio2pose_yaml_path'])
         cfg_pose = CN.load_cfg(fcfg_pose)
@@ -42,7 +58,7 @@ class Audio2Coeff():
         
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
+                checkpoints = load_safetensor_checkpoint(sadtalker_path['checkpoint'])
                 self.audio2pose_model.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2pose'))
             else:
                 load_cpk(sadtalker_path['audio2pose_checkpoint'], model=self.audio2pose_model, device=device)
@@ -57,7 +73,7 @@ class Audio2Coeff():
         netG.eval()
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
+                checkpoints = load_safetensor_checkpoint(sadtalker_path['checkpoint'])
                 netG.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2exp'))
             else:
                 load_cpk(sadtalker_path['audio2exp_checkpoint'], model=netG, device=device)
@@ -68,29 +84,51 @@ class Audio2Coeff():
         for param in self.audio2exp_model.parameters():
             param.requires_grad = False
         self.audio2exp_model.eval()
+
+        # both heads start from the same wav2lip audio encoder; when its weights are identical the
+        # mel windows are encoded once and the 512-d features feed audio2exp and audio2pose
+        self.share_audio_encoder = same_weights(netG.audio_encoder, self.audio2pose_model.audio_encoder.audio_encoder)
+        if self.share_audio_encoder:
+            print('audio2exp and audio2pose share the audio encoder, encoding the audio once.')
+
+        # the shared features of repeated audio clips are kept in the AudioFeatureCache, next to
+        # the mel, under a fingerprint of the encoder weights
+        self.audio_cache = audio_cache
+        self.audio_encoder_tag = weights_sha1(netG.audio_encoder) if audio_cache is not None else None
  
         self.device = device
 
-    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None):
+    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None, chunk_size=None, chunk_overlap=16, seed=None):
+        coeffs = self.predict(batch, pose_style, ref_pose_coeff_path, chunk_size, chunk_overlap, seed)
+        return save_coeffs(os.path.join(coeff_save_dir, coeffs['video_name']+'.npz'), coeff_3dmm=coeffs['coeff_3dmm'])
 
-        with torch.no_grad():
-            #test
-            results_dict_exp= self.audio2exp_model.test(batch)
-            exp_pred = results_dict_exp['exp_coeff_pred']                         #bs T 64
+    def predict(self, batch, pose_style, ref_pose_coeff_path=None, chunk_size=None, chunk_overlap=16, seed=None):
+        """ in-memory version of generate, `ref_pose_coeff_path` can also be the coeffs dict of CropAndExtract.extract.
+        `seed` makes the sampled head poses reproducible. """
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
 
+        with torch.no_grad():
             #for class_id in  range(1):
             #class_id = 0#(i+10)%45
             #class_id = random.randint(0,46)                                   #46 styles can be selected 
             batch['class'] = torch.LongTensor([pose_style]).to(self.device)
-            results_dict_pose = self.audio2pose_model.test(batch) 
-            pose_pred = results_dict_pose['pose_pred']                        #bs T 6
 
-            pose_len = pose_pred.shape[1]
-            if pose_len<13: 
-                pose_len = int((pose_len-1)/2)*2+1
-                pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), pose_len, 2, axis=1)).to(self.device)
+            if chunk_size or 'indiv_mels' not in batch:
+                exp_pred, pose_pred = self.predict_chunked(batch, chunk_size or 250, chunk_overlap, generator)
             else:
-                pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)).to(self.device) 
+                #test
+                if self.share_audio_encoder:
+                    batch['audio_feat'] = self.cached_audio_feat(batch)
+                    if batch['audio_feat'] is None:
+                        batch['audio_feat'] = self.encode_audio(batch['indiv_mels'])
+                        self.store_audio_feat(batch)
+                results_dict_exp= self.audio2exp_model.test(batch)
+                exp_pred = results_dict_exp['exp_coeff_pred']                         #bs T 64
+
+                results_dict_pose = self.audio2pose_model.test(batch, generator) 
+                pose_pred = results_dict_pose['pose_pred']                        #bs T 6
+
+            pose_pred = self.smooth_pose(pose_pred)
             
             coeffs_pred = torch.cat((exp_pred, pose_pred), dim=-1)            #bs T 70
 
@@ -99,14 +137,111 @@ class Audio2Coeff():
             if ref_pose_coeff_path is not None: 
                  coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
         
-            savemat(os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name'])),  
-                    {'coeff_3dmm': coeffs_pred_numpy})
-
-            return os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name']))
+            return {'coeff_3dmm': coeffs_pred_numpy, 'video_name': '%s##%s'%(batch['pic_name'], batch['audio_name'])}
     
+    def predict_batch(self, batches, pose_style, ref_pose_coeff_path=None, seed=None):
+        """
+        predict for several avatars driven by the same audio, `batches` are the get_data outputs of
+        each avatar. The audio is encoded once per head and both heads run with the avatars stacked
+        along the batch dimension. Returns one coeffs dict per avatar.
+        """
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        num_frames = batches[0]['num_frames']
+        assert all(batch['num_frames'] == num_frames for batch in batches), 'the avatars must share the driving audio'
+        bs = len(batches)
+
+        with torch.no_grad():
+            indiv_mels = batches[0]['indiv_mels'] if 'indiv_mels' in batches[0] else get_mel_chunk(batches[0], 0, num_frames, self.device)
+            stacked = {'ref': torch.cat([batch['ref'] for batch in batches], 0),                #bs T 70
+                       'ratio_gt': torch.cat([batch['ratio_gt'] for batch in batches], 0),      #bs T 1
+                       'num_frames': num_frames,
+                       'class': torch.LongTensor([pose_style]).to(self.device)}
+
+            # (1, T, 512) features of each head, shared by all avatars
+            exp_feat = self.cached_audio_feat(batches[0]) if self.share_audio_encoder else None
+            if exp_feat is None:
+                exp_feat = self.encode_audio(indiv_mels)
+                if self.share_audio_encoder:
+                    self.store_audio_feat(dict(batches[0], audio_feat=exp_feat))
+            if self.share_audio_encoder:
+                pose_feat = exp_feat
+            else:
+                micro_batch = auto_micro_batch(indiv_mels.device)
+                pose_feat = torch.cat([self.audio2pose_model.audio_encoder(indiv_mels[:, i:i+micro_batch])
+                                       for i in range(0, num_frames, micro_batch)], 1)
+
+            exp_pred = self.audio2exp_model.test(dict(stacked, indiv_mels=indiv_mels, audio_feat=exp_feat.expand(bs, -1, -1)))['exp_coeff_pred']
+            pose_pred = self.audio2pose_model.test(dict(stacked, indiv_mels=indiv_mels, audio_feat=pose_feat.expand(bs, -1, -1)), generator)['pose_pred']
+            coeffs_pred = torch.cat((exp_pred, self.smooth_pose(pose_pred)), dim=-1).cpu().numpy()           #bs T 70
+
+        results = []
+        for batch, coeffs_pred_numpy in zip(batches, coeffs_pred):
+            if ref_pose_coeff_path is not None: 
+                coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
+            results.append({'coeff_3dmm': coeffs_pred_numpy, 'video_name': '%s##%s'%(batch['pic_name'], batch['audio_name'])})
+        return results
+
+    def smooth_pose(self, pose_pred):
+        pose_len = pose_pred.shape[1]
+        if pose_len<13: 
+            pose_len = int((pose_len-1)/2)*2+1
+            return torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), pose_len, 2, axis=1)).to(self.device)
+        return torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)).to(self.device) 
+
+    def encode_audio(self, mel_input):
+        """ (bs, T, 1, 80, 16) mel windows -> (bs, T, 512) features shared by both heads """
+        return self.audio2exp_model.encode_audio(mel_input).reshape(mel_input.shape[0], mel_input.shape[1], -1)
+
+    def cached_audio_feat(self, batch):
+        """ (1, T, 512) features of this audio clip from the audio cache, or None """
+        if self.audio_cache is None or batch.get('audio_key') is None:
+            return None
+        feat = self.audio_cache.get_features(batch['audio_key'], self.audio_encoder_tag)
+        if feat is None or feat.shape[0] != batch['num_frames']:
+            return None
+        return torch.from_numpy(feat).to(self.device).unsqueeze(0)
+
+    def store_audio_feat(self, batch):
+        if self.audio_cache is None or batch.get('audio_key') is None or batch['audio_feat'].shape[0] != 1:
+            return
+        self.audio_cache.put_features(batch['audio_key'], self.audio_encoder_tag, batch['audio_feat'][0].cpu().numpy())
+
+    def predict_chunked(self, batch, chunk_size, overlap=16, generator=None):
+        """ audio2exp and audio2pose over chunks of `chunk_size` frames, each one preceded by `overlap`
+        frames of context. The expression is frame-wise; the poses of the overlapping frames are
+        cross-faded between neighbouring chunks to hide the restart of audio2pose. """
+        num_frames = batch['num_frames']
+        bs = batch['ref'].shape[0]
+        exp_pred = torch.zeros((bs, num_frames, 64), device=self.device)
+        pose_pred = torch.zeros((bs, num_frames, 6), device=self.device)
+        audio_feat = self.cached_audio_feat(batch) if self.share_audio_encoder else None
+
+        for start in tqdm(range(0, num_frames, chunk_size), 'audio2coeff:'):
+            end = min(start+chunk_size, num_frames)
+            context = max(start-overlap, 0)
+            chunk = {'indiv_mels': get_mel_chunk(batch, context, end, self.device),
+                     'ref': batch['ref'][:, context:end],
+                     'ratio_gt': batch['ratio_gt'][:, context:end],
+                     'num_frames': end-context,
+                     'class': batch['class']}
+            if audio_feat is not None:
+                chunk['audio_feat'] = audio_feat[:, context:end]
+            elif self.share_audio_encoder:
+                chunk['audio_feat'] = self.encode_audio(chunk['indiv_mels'])
+
+            exp_pred[:, start:end] = self.audio2exp_model.test(chunk)['exp_coeff_pred'][:, start-context:]
+
+            pose = self.audio2pose_model.test(chunk, generator)['pose_pred']
+            if start > context:
+                weight = torch.linspace(0, 1, start-context+2, device=self.device)[1:-1].view(1, -1, 1)
+                pose_pred[:, context:start] = pose_pred[:, context:start]*(1-weight) + pose[:, :start-context]*weight
+            pose_pred[:, start:end] = pose[:, start-context:]
+
+        return exp_pred, pose_pred
+
     def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff_path):
         num_frames = coeffs_pred_numpy.shape[0]
-        refpose_coeff_dict = loadmat(ref_pose_coeff_path)
+        refpose_coeff_dict = load_coeffs(ref_pose_coeff_path)
         refpose_coeff = refpose_coeff_dict['coeff_3dmm'][:,64:70]
         refpose_num_frames = refpose_coeff.shape[0]
         if refpose_num_frames<num_frames:
@@ -0,0 +1,101 @@
+"""Parity check for the audio encoder shared by audio2exp and audio2pose.
+
+    python -m src.test_audio2coeff_parity [--checkpoint_dir ./checkpoints]
+
+Builds both heads with random weights, ties the audio encoders and checks that Audio2Coeff.predict gives the
+same coeff_3dmm whether the mel windows are encoded once (batch['audio_feat'] set) or by each head, for the
+full and the chunked paths. When the checkpoints are available it also reports whether the shipped heads hold
+the same encoder weights, which is what enables the shared encoding by default.
+"""
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from yacs.config import CfgNode as CN
+
+from src.audio2pose_models.audio2pose import Audio2Pose
+from src.audio2exp_models.networks import SimpleWrapperV2
+from src.audio2exp_models.audio2exp import Audio2Exp
+from src.test_audio2coeff import Audio2Coeff, same_weights
+from src.utils.init_path import init_path
+
+config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+
+def build_tied_audio2coeff(device='cpu'):
+    torch.manual_seed(0)
+    cfg_pose = CN.load_cfg(open(os.path.join(config_dir, 'auido2pose.yaml')))
+    audio2pose_model = Audio2Pose(cfg_pose, None, device=device).to(device).eval()
+
+    netG = SimpleWrapperV2().to(device).eval()
+    # random BatchNorm statistics, so that the buffers are compared as well
+    for m in netG.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2)
+    audio2pose_model.audio_encoder.audio_encoder.load_state_dict(netG.audio_encoder.state_dict())
+
+    audio_to_coeff = Audio2Coeff.__new__(Audio2Coeff)
+    audio_to_coeff.audio2pose_model = audio2pose_model
+    audio_to_coeff.audio2exp_model = Audio2Exp(netG, None, device=device).eval()
+    audio_to_coeff.share_audio_encoder = same_weights(netG.audio_encoder, audio2pose_model.audio_encoder.audio_encoder)
+    audio_to_coeff.audio_cache = None
+    audio_to_coeff.audio_encoder_tag = None
+    audio_to_coeff.device = device
+    return audio_to_coeff
+
+def random_batch(num_frames=77, device='cpu'):
+    torch.manual_seed(1)
+    return {'indiv_mels': torch.randn(1, num_frames, 1, 80, 16, device=device),
+            'ref': torch.randn(1, num_frames, 70, device=device),
+            'ratio_gt': torch.rand(1, num_frames, 1, device=device),
+            'num_frames': num_frames, 'pic_name': 'source', 'audio_name': 'audio'}
+
+def check_parity(audio_to_coeff, batch, chunk_size=None, atol=1e-5):
+    coeffs = []
+    for share in [False, True]:
+        audio_to_coeff.share_audio_encoder = share
+        coeffs.append(audio_to_coeff.predict(dict(batch), 0, chunk_size=chunk_size, seed=0)['coeff_3dmm'])
+    audio_to_coeff.share_audio_encoder = True
+    diff = np.abs(coeffs[0] - coeffs[1]).max()
+    assert coeffs[0].shape == coeffs[1].shape and diff < atol, 'chunk_size=%s: max diff %g' % (chunk_size, diff)
+    return diff
+
+def check_encoded_once(audio_to_coeff, batch, chunk_size=None):
+    # with the shared features the audio2pose encoder must not run at all
+    pose_encoder = audio_to_coeff.audio2pose_model.audio_encoder
+    def fail(*args, **kwargs):
+        raise AssertionError('audio2pose encoded the audio again')
+    pose_encoder.forward = fail
+    try:
+        audio_to_coeff.predict(dict(batch), 0, chunk_size=chunk_size, seed=0)
+    finally:
+        del pose_encoder.forward
+
+def test_shared_audio_encoder_parity():
+    audio_to_coeff = build_tied_audio2coeff()
+    assert audio_to_coeff.share_audio_encoder
+    batch = random_batch()
+    for chunk_size in [None, 30]:
+        check_parity(audio_to_coeff, batch, chunk_size)
+        check_encoded_once(audio_to_coeff, batch, chunk_size)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="report whether these heads share the encoder")
+    parser.add_argument("--device", default='cpu')
+    args = parser.parse_args()
+
+    audio_to_coeff = build_tied_audio2coeff(args.device)
+    batch = random_batch(device=args.device)
+    for chunk_size in [None, 30]:
+        diff = check_parity(audio_to_coeff, batch, chunk_size)
+        check_encoded_once(audio_to_coeff, batch, chunk_size)
+        print('chunk_size=%s: max diff %g, audio encoded once' % (chunk_size, diff))
+
+    if os.path.isdir(args.checkpoint_dir):
+        sadtalker_paths = init_path(args.checkpoint_dir, config_dir)
+        shipped = Audio2Coeff(sadtalker_paths, args.device)
+        print('checkpoints in %s share the audio encoder: %s' % (args.checkpoint_dir, shipped.share_audio_encoder))
+    else:
+        print('no checkpoints in %s, skipping the check of the shipped weights' % args.checkpoint_dir)
@@ -0,0 +1,63 @@
+"""
+Storage of the pipeline intermediates: 3dmm coefficients as uncompressed .npz bundles and
+landmarks as (N, 68, 2) float32 .npy arrays. Legacy .mat coefficients and .txt landmarks can
+still be read, and old .mat files can be converted with
+
+    python -m src.utils.coeff_io results/some_run/ first_frame_dir/image.mat
+"""
+import os
+import sys
+
+import numpy as np
+
+
+def save_coeffs(path, **arrays):
+    with open(path, 'wb') as f:
+        np.savez(f, **{k: np.asarray(v) for k, v in arrays.items()})
+    return path
+
+
+def load_coeffs(path):
+    """ dict of the arrays in a .npz bundle, or in a legacy .mat file. Dicts handed over in memory are returned as they are. """
+    if isinstance(path, dict):
+        return path
+    if path.endswith('.mat'):
+        from scipy.io import loadmat
+        return {k: v for k, v in loadmat(path).items() if not k.startswith('__')}
+    with np.load(path) as bundle:
+        return {k: bundle[k] for k in bundle.files}
+
+
+def save_landmarks(path, landmarks):
+    np.save(path, np.asarray(landmarks, dtype=np.float32).reshape(-1, 68, 2))
+    return path
+
+
+def load_landmarks(path):
+    if path.endswith('.txt'):
+        return np.loadtxt(path).astype(np.float32).reshape(-1, 68, 2)
+    return np.load(path)
+
+
+def dump_coeffs_txt(path, coeffs):
+    """ human readable dump, for debugging only """
+    with open(path, 'w') as f:
+        for coeff in coeffs:
+            f.write(''.join(str(i)[:7] + '  '+'\t' for i in coeff))
+            f.write('\n')
+
+
+def convert_mat(mat_path, npz_path=None):
+    if npz_path is None:
+        npz_path = os.path.splitext(mat_path)[0] + '.npz'
+    return save_coeffs(npz_path, **load_coeffs(mat_path))
+
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            paths = [os.path.join(root, name) for root, _, names in os.walk(arg) for name in names if name.endswith('.mat')]
+        else:
+            paths = [arg]
+        for path in paths:
+            print(path, '->', convert_mat(path))
@@ -17,19 +17,28 @@ import numpy as np
 from PIL import Image
 
 class Preprocesser:
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', det_max_side=1600):
         self.predictor = KeypointExtractor(device)
+        # faces are detected on a copy of the image downscaled to this longest side, None for full resolution
+        self.det_max_side = det_max_side
 
     def get_landmark(self, img_np):
         """get landmark with dlib
         :return: np.array shape=(68, 2)
         """
+        scale = 1.
+        det_img = img_np
+        if self.det_max_side is not None and max(img_np.shape[:2]) > self.det_max_side:
+            scale = self.det_max_side / max(img_np.shape[:2])
+            det_img = cv2.resize(img_np, (round(img_np.shape[1]*scale), round(img_np.shape[0]*scale)), interpolation=cv2.INTER_AREA)
+
         with torch.no_grad():
-            dets = self.predictor.det_net.detect_faces(img_np, 0.97)
+            dets = self.predictor.det_net.detect_faces(det_img, 0.97)
 
         if len(dets) == 0:
             return None
-        det = dets[0]
+        # back to the full resolution image, FAN runs on the native face crop
+        det = np.clip(dets[0][:4] / scale, 0, [img_np.shape[1], img_np.shape[0]] * 2)
 
         img = img_np[int(det[1]):int(det[3]), int(det[0]):int(det[2]), :]
         lm = landmark_98_to_68(self.predictor.detector.get_landmarks(img)) # [0]
@@ -123,22 +132,57 @@ class Preprocesser:
         # Save aligned image.
         return rsize, crop, [lx, ly, rx, ry]
     
-    def crop(self, img_np_list, still=False, xsize=512):    # first frame for all video
-        img_np = img_np_list[0]
+    def crop_params(self, img_np, xsize=512):
+        """ resize, crop and quad of the face in `img_np`, shared by all frames of a clip """
         lm = self.get_landmark(img_np)
 
         if lm is None:
             raise 'can not detect the landmark from source image'
-        rsize, crop, quad = self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        return self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+
+    def crop_transform(self, img_shape, rsize, crop, quad, still=False, out_size=None):
+        """
+        The resize to `rsize`, the crop and the optional final resize to `out_size` composed into
+        one affine map (output pixel -> input pixel, for cv2.WARP_INVERSE_MAP), the output size and
+        the box filter that stands in for the antialiasing of the downscales.
+        """
         clx, cly, crx, cry = crop
         lx, ly, rx, ry = quad
         lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+        # the region of the resized frame kept by the crop, clamped like the slicing it replaces
+        x0, y0, x1, y1 = clx, cly, crx, cry
+        if not still:
+            x0, y0, x1, y1 = clx+lx, cly+ly, min(clx+rx, crx), min(cly+ry, cry)
+        w, h = x1 - x0, y1 - y0
+        out_w, out_h = (w, h) if out_size is None else out_size
+
+        # pixel centers: output -> resized frame -> input frame
+        fx, fy = img_shape[1] / rsize[0], img_shape[0] / rsize[1]
+        sx, sy = w / out_w, h / out_h
+        M = np.array([[sx*fx, 0, (0.5*sx + x0)*fx - 0.5],
+                      [0, sy*fy, (0.5*sy + y0)*fy - 0.5]])
+        # bilinear sampling aliases on large downscales, the integer factor of the box filter applied first:
+        # the shrink to `rsize`, times the final resize when that shrinks further
+        box = (max(int(round(fx*max(sx, 1))), 1), max(int(round(fy*max(sy, 1))), 1))
+        return M, (out_w, out_h), box
+
+    def apply_crop(self, img_np, rsize, crop, quad, still=False, out_size=None, transform=None):
+        """ crop `img_np` without resizing the whole frame; pass the `transform` of crop_transform to reuse it across frames """
+        M, size, (kx, ky) = transform if transform is not None else self.crop_transform(img_np.shape, rsize, crop, quad, still, out_size)
+        if kx > 1 or ky > 1:
+            # box-filter the source region of the crop (INTER_AREA on boxes aligned with the frame), the warp does the rest
+            x0 = max(int(M[0, 2]) - 2*kx, 0) // kx * kx
+            y0 = max(int(M[1, 2]) - 2*ky, 0) // ky * ky
+            w = (min(int(np.ceil(M[0, 2] + M[0, 0]*size[0])) + 2*kx, img_np.shape[1]) - x0) // kx
+            h = (min(int(np.ceil(M[1, 2] + M[1, 1]*size[1])) + 2*ky, img_np.shape[0]) - y0) // ky
+            img_np = cv2.resize(img_np[y0:y0 + h*ky, x0:x0 + w*kx], (w, h), interpolation=cv2.INTER_AREA)
+            M = np.array([[M[0, 0]/kx, 0, (M[0, 2] - x0 + 0.5)/kx - 0.5],
+                          [0, M[1, 1]/ky, (M[1, 2] - y0 + 0.5)/ky - 0.5]])
+        return cv2.warpAffine(img_np, M, size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+
+    def crop(self, img_np_list, still=False, xsize=512):    # first frame for all video
+        rsize, crop, quad = self.crop_params(img_np_list[0], xsize)
+        transform = self.crop_transform(img_np_list[0].shape, rsize, crop, quad, still)
         for _i in range(len(img_np_list)):
-            _inp = img_np_list[_i]
-            _inp = cv2.resize(_inp, (rsize[0], rsize[1]))
-            _inp = _inp[cly:cry, clx:crx]
-            if not still:
-                _inp = _inp[ly:ry, lx:rx]
-            img_np_list[_i] = _inp
+            img_np_list[_i] = self.apply_crop(img_np_list[_i], rsize, crop, quad, still, transform=transform)
         return img_np_list, crop, quad
-
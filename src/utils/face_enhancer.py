@@ -1,12 +1,13 @@
 import os
+import queue
+import threading
 import torch 
 
 from gfpgan import GFPGANer
+from basicsr.utils import img2tensor, tensor2img
 
 from tqdm import tqdm
 
-from src.utils.videoio import load_video_to_cv2
-
 import cv2
 
 
@@ -31,22 +32,40 @@ def enhancer_generator_with_len(images, method='gfpgan', bg_upsampler='realesrga
     """ Provide a generator with a __len__ method so that it can passed to functions that
     call len()"""
 
-    if os.path.isfile(images): # handle video to images
-        # TODO: Create a generator version of load_video_to_cv2
-        images = load_video_to_cv2(images)
+    if isinstance(images, str) and os.path.isfile(images): # only read the frame count of videos
+        video_stream = cv2.VideoCapture(images)
+        length = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        video_stream.release()
+    else:
+        length = len(images)
 
     gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
-    gen_with_len = GeneratorWithLen(gen, len(images))
+    gen_with_len = GeneratorWithLen(gen, length)
     return gen_with_len
 
-def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'):
+def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan', batch_size=8):
     """ Provide a generator function so that all of the enhanced images don't need
     to be stored in memory at the same time. This can save tons of RAM compared to
     the enhancer function. """
 
     print('face enhancer....')
-    if not isinstance(images, list) and os.path.isfile(images): # handle video to images
-        images = load_video_to_cv2(images)
+    for r_img in tqdm(enhancer_stream(images, method, bg_upsampler, batch_size), 'Face Enhancer:'):
+        yield r_img
+
+
+_restorers = {}
+
+def get_restorer(method='gfpgan', bg_upsampler='realesrgan'):
+    """ One restorer per (method, bg_upsampler) and process, the weights are only loaded once. """
+    key = (method, bg_upsampler)
+    if key not in _restorers:
+        _restorers[key] = build_restorer(method, bg_upsampler)
+    return _restorers[key]
+
+def release_restorers():
+    _restorers.clear()
+
+def build_restorer(method='gfpgan', bg_upsampler='realesrgan'):
 
     # ------------------------ set up GFPGAN restorer ------------------------
     if  method == 'gfpgan':
@@ -100,24 +119,133 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
         # download pre-trained models from url
         model_path = url
 
-    restorer = GFPGANer(
+    return GFPGANer(
         model_path=model_path,
         upscale=2,
         arch=arch,
         channel_multiplier=channel_multiplier,
         bg_upsampler=bg_upsampler)
 
-    # ------------------------ restore ------------------------
-    for idx in tqdm(range(len(images)), 'Face Enhancer:'):
-        
-        img = cv2.cvtColor(images[idx], cv2.COLOR_RGB2BGR)
-        
-        # restore faces and background if necessary
-        cropped_faces, restored_faces, r_img = restorer.enhance(
-            img,
-            has_aligned=False,
-            only_center_face=False,
-            paste_back=True)
-        
-        r_img = cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
-        yield r_img
+
+@torch.no_grad()
+def restore_batch(restorer, images, weight=0.5):
+    """
+    Same as `restorer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)`
+    for a list of BGR frames, but the face crops of all frames go through GFPGAN in one batch.
+    Detection, alignment and paste-back still run frame by frame on the restorer's face helper.
+    """
+    helper = restorer.face_helper
+    states, cropped_faces = [], []
+    for img in images:
+        helper.clean_all()
+        helper.read_image(img)
+        helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+        helper.align_warp_face()
+        # clean_all() rebinds the per-image lists, a shallow copy keeps this frame's faces
+        states.append(dict(helper.__dict__))
+        cropped_faces.extend(helper.cropped_faces)
+
+    restored_faces = []
+    if cropped_faces:
+        faces = torch.stack([img2tensor(face / 255., bgr2rgb=True, float32=True) for face in cropped_faces])
+        faces = ((faces - 0.5) / 0.5).to(restorer.device)
+        output = restorer.gfpgan(faces, return_rgb=False, weight=weight)[0]
+        restored_faces = [tensor2img(face, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for face in output]
+
+    results = []
+    for img, state in zip(images, states):
+        helper.__dict__.update(state)
+        for _ in range(len(helper.cropped_faces)):
+            helper.add_restored_face(restored_faces.pop(0))
+
+        # upsample the background
+        if restorer.bg_upsampler is not None:
+            bg_img = restorer.bg_upsampler.enhance(img, outscale=restorer.upscale)[0]
+        else:
+            bg_img = None
+
+        helper.get_inverse_affine(None)
+        results.append(helper.paste_faces_to_input_image(upsample_img=bg_img))
+    return results
+
+# the restorers are shared, their face helper keeps the state of the frame being restored
+_restorer_lock = threading.Lock()
+
+def enhance_batch(restorer, images):
+    with _restorer_lock:
+        try:
+            return restore_batch(restorer, images)
+        except RuntimeError as error:
+            # e.g. out of memory for a frame with many faces, restore them one by one
+            print(f'\tFailed batched inference for GFPGAN: {error}.')
+            return [restorer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)[2] for img in images]
+
+
+def iter_images(images):
+    """ Frames of a video file, or any iterable of RGB frames (list, generator). """
+    if isinstance(images, str) and os.path.isfile(images):
+        video_stream = cv2.VideoCapture(images)
+        while 1:
+            still_reading, frame = video_stream.read()
+            if not still_reading:
+                video_stream.release()
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    else:
+        for image in images:
+            yield image
+
+_END = object()
+
+def enhancer_stream(images, method='gfpgan', bg_upsampler='realesrgan', batch_size=8, max_queue=32):
+    """
+    Enhance `images` (a video path or an iterable of RGB frames) as a pipeline: a producer thread
+    decodes (or pulls from the upstream generator) into a bounded queue, this generator restores
+    the frames `batch_size` at a time and the caller encodes the results as they are yielded.
+    """
+    restorer = get_restorer(method, bg_upsampler)
+    frame_queue = queue.Queue(maxsize=max_queue)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for image in iter_images(images):
+                if not put(image):
+                    return
+        except Exception as e:
+            put(e)
+        put(_END)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        batch = []
+        while True:
+            item = frame_queue.get()
+            if item is not _END and not isinstance(item, Exception):
+                batch.append(cv2.cvtColor(item, cv2.COLOR_RGB2BGR))
+            if len(batch) == batch_size or (item is _END and batch):
+                for r_img in enhance_batch(restorer, batch):
+                    yield cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
+                batch = []
+            if isinstance(item, Exception):
+                raise item
+            if item is _END:
+                break
+    finally:
+        # the consumer may stop early (writer error, generator closed): the producer gives up at its next
+        # put, then the upstream generator is closed so that its render/decode work and frames are released
+        stop.set()
+        producer.join()
+        if hasattr(images, 'close'):
+            images.close()
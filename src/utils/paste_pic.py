@@ -1,69 +1,66 @@
 import cv2, os
 import numpy as np
 from tqdm import tqdm
-import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from src.utils.videoio import save_video_with_watermark 
-
-def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False):
+from src.utils.videoio import FFmpegVideoWriter, FrameSource
 
+def load_full_img(pic_path):
+    """ The first frame of the source image/video in BGR. """
     if not os.path.isfile(pic_path):
         raise ValueError('pic_path must be a valid path to video/image file')
-    elif pic_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
-        # loader for first frame
-        full_img = cv2.imread(pic_path)
+    return next(iter(FrameSource(pic_path, rgb=False, max_frames=1)))
+
+def paste_box(crop_info, extended_crop=False):
+    r_w, r_h = crop_info[0]
+    clx, cly, crx, cry = crop_info[1]
+    lx, ly, rx, ry = crop_info[2]
+    lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+    # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+
+    if extended_crop:
+        oy1, oy2, ox1, ox2 = cly, cry, clx, crx
     else:
-        # loader for videos
-        video_stream = cv2.VideoCapture(pic_path)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-        full_frames = [] 
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break 
-            break 
-        full_img = frame
-    frame_h = full_img.shape[0]
-    frame_w = full_img.shape[1]
+        oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+    return oy1, oy2, ox1, ox2
+
+def paste_frames(crop_frames, full_img, crop_info, extended_crop=False, num_workers=4):
+    """
+    Blend the rendered crops back into `full_img`, yielding the full frames in order.
+    `crop_frames` can be any iterable of arrays in the same channel order as `full_img`.
+    The mask and the paste location are computed once, the seamlessClone calls run on a
+    thread pool (OpenCV releases the GIL) with a bounded number of frames in flight.
+    """
+    oy1, oy2, ox1, ox2 = paste_box(crop_info, extended_crop)
+    size = (ox2-ox1, oy2-oy1)
+    mask = 255*np.ones((size[1], size[0], full_img.shape[2]), np.uint8)
+    location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
+
+    def blend(crop_frame):
+        p = cv2.resize(crop_frame.astype(np.uint8), size)
+        return cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        pending = deque()
+        for crop_frame in crop_frames:
+            pending.append(pool.submit(blend, crop_frame))
+            if len(pending) >= 2*num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False, audio_duration=None):
 
-    video_stream = cv2.VideoCapture(video_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    crop_frames = []
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
-            video_stream.release()
-            break
-        crop_frames.append(frame)
-    
     if len(crop_info) != 3:
         print("you didn't crop the image")
         return
-    else:
-        r_w, r_h = crop_info[0]
-        clx, cly, crx, cry = crop_info[1]
-        lx, ly, rx, ry = crop_info[2]
-        lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-        # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-        # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-
-        if extended_crop:
-            oy1, oy2, ox1, ox2 = cly, cry, clx, crx
-        else:
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-
-    tmp_path = str(uuid.uuid4())+'.mp4'
-    out_tmp = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*'MP4V'), fps, (frame_w, frame_h))
-    for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
-        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
 
-        mask = 255*np.ones(p.shape, p.dtype)
-        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
-        gen_img = cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
-        out_tmp.write(gen_img)
+    full_img = load_full_img(pic_path)
 
-    out_tmp.release()
+    # decoded lazily, in BGR like full_img
+    crop_frames = FrameSource(video_path, rgb=False)
 
-    save_video_with_watermark(tmp_path, new_audio_path, full_video_path, watermark=False)
-    os.remove(tmp_path)
+    with FFmpegVideoWriter(full_video_path, new_audio_path, audio_duration, crop_frames.fps) as writer:
+        for gen_img in tqdm(paste_frames(crop_frames, full_img, crop_info, extended_crop), 'seamlessClone:', total=len(crop_frames)):
+            writer.write(cv2.cvtColor(gen_img, cv2.COLOR_BGR2RGB))
@@ -6,17 +6,18 @@ from PIL import Image
 # 3dmm extraction
 import safetensors
 import safetensors.torch 
-from src.face3d.util.preprocess import align_img
+from src.face3d.util.preprocess import align_img_batch, extract_5p_batch
 from src.face3d.util.load_mats import load_lm3d
 from src.face3d.models import networks
 
-from scipy.io import loadmat, savemat
+from src.utils.coeff_io import save_coeffs, save_landmarks, load_landmarks
 from src.utils.croper import Preprocesser
+from src.utils.videoio import FrameSource
 
 
 import warnings
 
-from src.utils.safetensor_helper import load_x_from_safetensor 
+from src.utils.safetensor_helper import load_x_from_safetensor, load_safetensor_checkpoint
 warnings.filterwarnings("ignore")
 
 def split_coeff(coeffs):
@@ -44,13 +45,13 @@ def split_coeff(coeffs):
 
 
 class CropAndExtract():
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, preprocess_cache=None):
 
         self.propress = Preprocesser(device)
         self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
         
         if sadtalker_path['use_safetensor']:
-            checkpoint = safetensors.torch.load_file(sadtalker_path['checkpoint'])    
+            checkpoint = load_safetensor_checkpoint(sadtalker_path['checkpoint'])
             self.net_recon.load_state_dict(load_x_from_safetensor(checkpoint, 'face_3drecon'))
         else:
             checkpoint = torch.load(sadtalker_path['path_of_net_recon_model'], map_location=torch.device(device))    
@@ -59,112 +60,153 @@ class CropAndExtract():
         self.net_recon.eval()
         self.lm3d_std = load_lm3d(sadtalker_path['dir_of_BFM_fitting'])
         self.device = device
+        self.preprocess_cache = preprocess_cache
     
-    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256):
-
-        pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
-
-        landmarks_path =  os.path.join(save_dir, pic_name+'_landmarks.txt') 
-        coeff_path =  os.path.join(save_dir, pic_name+'.mat')  
-        png_path =  os.path.join(save_dir, pic_name+'.png')  
-
-        #load input
+    def extract_3dmm(self, frames_pil, lm, batch_size=32, info=True):
+        """ 3dmm coefficients of all frames, aligned and reconstructed `batch_size` frames at a time.
+        Returns the (N, 73) exp/angle/trans/crop coefficients and the (N, 257) full coefficients. """
+        video_coeffs, full_coeffs = [], []
+        batches = range(0, len(frames_pil), batch_size)
+        for start in tqdm(batches, desc='3DMM Extraction In Video:') if info else batches:
+            frames = frames_pil[start:start+batch_size]
+            lm1 = np.asarray(lm[start:start+batch_size], dtype=np.float64).reshape([len(frames), -1, 2]).copy()
+            size = np.array([frame.size for frame in frames], dtype=np.float64)   # N 2 (W, H)
+
+            # frames without a face fall back to the standard landmarks
+            missing = lm1.mean(axis=(1, 2)) == -1
+            lm1[:, :, 1] = size[:, 1:2] - 1 - lm1[:, :, 1]
+            lm5p = extract_5p_batch(lm1)
+            lm5p[missing] = (self.lm3d_std[None, :, :2]+1)/2. * size[missing][:, None, :]
+
+            trans_params, im1, _ = align_img_batch(frames, lm5p, self.lm3d_std)
+            im_t = torch.tensor(im1/255., dtype=torch.float32).permute(0, 3, 1, 2).to(self.device)
+
+            with torch.no_grad():
+                full_coeff = self.net_recon(im_t)
+                coeffs = split_coeff(full_coeff)
+
+            pred_coeff = {key:coeffs[key].cpu().numpy() for key in ['exp', 'angle', 'trans']}
+            video_coeffs.append(np.concatenate([
+                pred_coeff['exp'], 
+                pred_coeff['angle'],
+                pred_coeff['trans'],
+                trans_params[:, 2:].astype(np.float32),
+                ], 1))
+            full_coeffs.append(full_coeff.cpu().numpy())
+
+        return np.concatenate(video_coeffs, 0), np.concatenate(full_coeffs, 0)
+    
+    def extract(self, input_path, crop_or_resize='crop', source_image_flag=False, pic_size=256, chunk_size=64, track_landmarks=False,
+                landmarks=None, extract_coeff=True):
+        """
+        In-memory preprocessing, nothing is written to disk (apart from the preprocessing cache).
+        Returns a dict with the cropped `crop_pic` (RGB, pic_size x pic_size), `crop_info`, the 68
+        `landmarks` of every frame and the `coeff_3dmm`/`full_3dmm` coefficients, or None when the
+        input has no frame. Pass `landmarks` to reuse known landmarks.
+        """
         if not os.path.isfile(input_path):
             raise ValueError('input_path must be a valid path to video/image file')
-        elif input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
-            # loader for first frame
-            full_frames = [cv2.imread(input_path)]
-            fps = 25
-        else:
-            # loader for videos
-            video_stream = cv2.VideoCapture(input_path)
-            fps = video_stream.get(cv2.CAP_PROP_FPS)
-            full_frames = [] 
-            while 1:
-                still_reading, frame = video_stream.read()
-                if not still_reading:
-                    video_stream.release()
-                    break 
-                full_frames.append(frame) 
-                if source_image_flag:
-                    break
-
-        x_full_frames= [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  for frame in full_frames] 
+        pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
+
+        cache_key = None
+        if self.preprocess_cache is not None and landmarks is None and extract_coeff:
+            cache_key = self.preprocess_cache.make_key(input_path, crop_or_resize, source_image_flag, pic_size, track_landmarks)
+            result = self.preprocess_cache.get(cache_key)
+            if result is not None:
+                print(' Using cached preprocessing results.')
+                result['pic_name'] = pic_name
+                return result
+
+        # decoded lazily and processed `chunk_size` frames at a time
+        frames = FrameSource(input_path, max_frames=1 if source_image_flag else None)
+        first_frame = next(iter(frames), None)
+        if first_frame is None:
+            print('No face is detected in the input file')
+            return None
 
         #### crop images as the 
-        if 'crop' in crop_or_resize.lower(): # default crop
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
-            clx, cly, crx, cry = crop
-            lx, ly, rx, ry = quad
-            lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-            crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
-        elif 'full' in crop_or_resize.lower():
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
+        if 'crop' in crop_or_resize.lower() or 'full' in crop_or_resize.lower(): # default crop
+            still = True if 'ext' in crop_or_resize.lower() else False
+            rsize, crop, quad = self.propress.crop_params(first_frame, xsize=512)
             clx, cly, crx, cry = crop
             lx, ly, rx, ry = quad
             lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
             crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
+            # resize, crop and resize to pic_size in one warp per frame
+            transform = self.propress.crop_transform(first_frame.shape, rsize, crop, quad, still, (pic_size, pic_size))
+            to_pil = lambda frame: Image.fromarray(self.propress.apply_crop(frame, rsize, crop, quad, transform=transform))
         else: # resize mode
-            oy1, oy2, ox1, ox2 = 0, x_full_frames[0].shape[0], 0, x_full_frames[0].shape[1] 
+            oy1, oy2, ox1, ox2 = 0, first_frame.shape[0], 0, first_frame.shape[1] 
             crop_info = ((ox2 - ox1, oy2 - oy1), None, None)
-
-        frames_pil = [Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames]
-        if len(frames_pil) == 0:
-            print('No face is detected in the input file')
-            return None, None
+            to_pil = lambda frame: Image.fromarray(cv2.resize(frame, (pic_size, pic_size)))
+
+        # detect on keyframes only and follow the face in between
+        track = {} if track_landmarks else None
+        lm_list, coeff_list, full_coeff_list = [], [], []
+        num_frames = 0
+        for chunk in tqdm(frames.chunks(chunk_size), desc='landmark Det and 3DMM Extraction:', total=(len(frames) + chunk_size - 1) // chunk_size):
+            frames_pil = [to_pil(frame) for frame in chunk]
+
+            # 2. get the landmark according to the detected face. 
+            if landmarks is None:
+                lm = self.propress.predictor.extract_keypoint(frames_pil, info=False, track=track)
+                # carry the last detected face over frames without a face, across chunks too
+                for idx in range(len(lm)):
+                    if np.mean(lm[idx]) != -1 or not lm_list:
+                        break
+                    lm[idx] = lm_list[-1][-1]
+            else:
+                lm = landmarks[num_frames:num_frames+len(frames_pil)]
+            lm_list.append(lm)
+
+            if extract_coeff:
+                # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
+                coeff, full_coeff = self.extract_3dmm(frames_pil, lm, info=False)
+                coeff_list.append(coeff)
+                full_coeff_list.append(full_coeff[:1])
+            num_frames += len(frames_pil)
+
+        result = {'pic_name': pic_name, 'crop_info': crop_info,
+                  'crop_pic': np.array(frames_pil[-1]),
+                  'landmarks': np.concatenate(lm_list, 0).astype(np.float32)}
+        if extract_coeff:
+            result['coeff_3dmm'] = np.concatenate(coeff_list, 0)
+            result['full_3dmm'] = full_coeff_list[0]
+
+        if cache_key is not None:
+            self.preprocess_cache.put(cache_key, result)
+        return result
+
+    def save(self, result, save_dir):
+        """ write the result of extract like generate does, returns (coeff_path, png_path, crop_info) """
+        pic_name = result['pic_name']
+        landmarks_path =  os.path.join(save_dir, pic_name+'_landmarks.npy') 
+        coeff_path =  os.path.join(save_dir, pic_name+'.npz')  
+        png_path =  os.path.join(save_dir, pic_name+'.png')  
 
         # save crop info
-        for frame in frames_pil:
-            cv2.imwrite(png_path, cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR))
+        cv2.imwrite(png_path, cv2.cvtColor(result['crop_pic'], cv2.COLOR_RGB2BGR))
+        if not os.path.isfile(landmarks_path):
+            save_landmarks(landmarks_path, result['landmarks'])
+        if 'coeff_3dmm' in result:
+            save_coeffs(coeff_path, coeff_3dmm=result['coeff_3dmm'], full_3dmm=result['full_3dmm'])
+        return coeff_path, png_path, result['crop_info']
 
-        # 2. get the landmark according to the detected face. 
-        if not os.path.isfile(landmarks_path): 
-            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path)
-        else:
+    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256, chunk_size=64, track_landmarks=False):
+
+        pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
+
+        landmarks_path =  os.path.join(save_dir, pic_name+'_landmarks.npy') 
+        coeff_path =  os.path.join(save_dir, pic_name+'.npz')  
+
+        saved_lm = None
+        if os.path.isfile(landmarks_path): 
             print(' Using saved landmarks.')
-            lm = np.loadtxt(landmarks_path).astype(np.float32)
-            lm = lm.reshape([len(x_full_frames), -1, 2])
-
-        if not os.path.isfile(coeff_path):
-            # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
-            video_coeffs, full_coeffs = [],  []
-            for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
-                frame = frames_pil[idx]
-                W,H = frame.size
-                lm1 = lm[idx].reshape([-1, 2])
-            
-                if np.mean(lm1) == -1:
-                    lm1 = (self.lm3d_std[:, :2]+1)/2.
-                    lm1 = np.concatenate(
-                        [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
-                    )
-                else:
-                    lm1[:, -1] = H - 1 - lm1[:, -1]
-
-                trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
- 
-                trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-                im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
-                
-                with torch.no_grad():
-                    full_coeff = self.net_recon(im_t)
-                    coeffs = split_coeff(full_coeff)
-
-                pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
- 
-                pred_coeff = np.concatenate([
-                    pred_coeff['exp'], 
-                    pred_coeff['angle'],
-                    pred_coeff['trans'],
-                    trans_params[2:][None],
-                    ], 1)
-                video_coeffs.append(pred_coeff)
-                full_coeffs.append(full_coeff.cpu().numpy())
-
-            semantic_npy = np.array(video_coeffs)[:,0] 
-
-            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0]})
-
-        return coeff_path, png_path, crop_info
+            saved_lm = load_landmarks(landmarks_path)
+
+        result = self.extract(input_path, crop_or_resize, source_image_flag, pic_size, chunk_size, track_landmarks,
+                              landmarks=saved_lm, extract_coeff=not os.path.isfile(coeff_path))
+        if result is None:
+            return None, None, None
+        return self.save(result, save_dir)
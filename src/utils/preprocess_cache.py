@@ -0,0 +1,190 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+
+import cv2
+import numpy as np
+
+from src.utils.coeff_io import save_coeffs, load_coeffs, save_landmarks, load_landmarks
+from src.utils.hparams import hparams
+
+# bump when the preprocessing results change for the same input
+CACHE_VERSION = 'v4'
+AUDIO_CACHE_VERSION = 'v1'
+
+
+def _to_json(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f'{type(o)} is not serializable')
+
+
+def dump_crop_info(crop_info):
+    return json.dumps(crop_info, default=_to_json)
+
+
+def load_crop_info(text):
+    size, crop, quad = json.loads(text)
+    return tuple(size), tuple(crop) if crop is not None else None, quad
+
+
+def file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha
+
+
+class DiskCache():
+    """ A folder of cache entries, one sub-folder per key, trimmed by least recent use to `max_bytes`. """
+
+    def __init__(self, cache_dir, max_bytes=2*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = self._entry(name)
+            if name.startswith('.tmp-') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # changed by another process in the meantime
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class PreprocessCache(DiskCache):
+    """
+    Persistent cache of the CropAndExtract.extract results, keyed by the content of the input file
+    and the preprocessing options. Each entry is a folder with the cropped png, the landmarks,
+    the 3dmm coefficients and the crop info; the least recently used entries are removed
+    once the folder grows over `max_bytes`.
+    """
+
+    @staticmethod
+    def make_key(input_path, crop_or_resize, source_image_flag, pic_size, track_landmarks=False):
+        sha = file_sha1(input_path)
+        sha.update(f'{CACHE_VERSION}|{crop_or_resize.lower()}|{bool(source_image_flag)}|{pic_size}'.encode())
+        if track_landmarks:
+            sha.update(b'|track')
+        return sha.hexdigest()
+
+    def get(self, key):
+        """ The cached result of CropAndExtract.extract, or None on a miss. """
+        entry = self._entry(key)
+        info_path = os.path.join(entry, 'crop_info.json')
+        if not os.path.isfile(info_path):
+            return None
+        try:
+            crop_pic = cv2.imread(os.path.join(entry, 'crop.png'))
+            result = load_coeffs(os.path.join(entry, 'coeff.npz'))
+            result['landmarks'] = load_landmarks(os.path.join(entry, 'landmarks.npy'))
+            with open(info_path) as f:
+                result['crop_info'] = load_crop_info(f.read())
+        except (OSError, ValueError):
+            # evicted by another process in the meantime, or a broken entry
+            return None
+        if crop_pic is None:
+            return None
+        result['crop_pic'] = cv2.cvtColor(crop_pic, cv2.COLOR_BGR2RGB)
+        os.utime(entry)
+        return result
+
+    def put(self, key, result):
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = os.path.join(self.cache_dir, '.tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_entry)
+        cv2.imwrite(os.path.join(tmp_entry, 'crop.png'), cv2.cvtColor(result['crop_pic'], cv2.COLOR_RGB2BGR))
+        save_landmarks(os.path.join(tmp_entry, 'landmarks.npy'), result['landmarks'])
+        save_coeffs(os.path.join(tmp_entry, 'coeff.npz'), coeff_3dmm=result['coeff_3dmm'], full_3dmm=result['full_3dmm'])
+        with open(os.path.join(tmp_entry, 'crop_info.json'), 'w') as f:
+            f.write(dump_crop_info(result['crop_info']))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # the same input was stored concurrently
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+
+class AudioFeatureCache(DiskCache):
+    """
+    Persistent cache of the audio side of a request, keyed by the content of the audio file and the
+    mel hparams: the normalized mel spectrogram with the number of video frames, and the audio encoder
+    features of each model that stored them. The indiv_mels windows are one gather away from the
+    mel (see generate_batch.get_indiv_mels), so they are not stored.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024**3):
+        super().__init__(cache_dir, max_bytes)
+
+    @staticmethod
+    def make_key(audio_path, sr=16000, fps=25):
+        sha = file_sha1(audio_path)
+        sha.update(f'{AUDIO_CACHE_VERSION}|{sr}|{fps}|'.encode())
+        sha.update(json.dumps(hparams.data, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def get(self, key):
+        """ dict with the `orig_mel` (nframes, 80) and `num_frames`, or None on a miss """
+        entry = self._entry(key)
+        try:
+            result = load_coeffs(os.path.join(entry, 'mel.npz'))
+        except (OSError, ValueError):
+            return None
+        os.utime(entry)
+        return {'orig_mel': result['orig_mel'], 'num_frames': int(result['num_frames'])}
+
+    def put(self, key, orig_mel, num_frames):
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = os.path.join(self.cache_dir, '.tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_entry)
+        save_coeffs(os.path.join(tmp_entry, 'mel.npz'), orig_mel=orig_mel.astype(np.float32), num_frames=num_frames)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def get_features(self, key, tag):
+        """ (T, C) audio encoder features stored under `tag` (a fingerprint of the encoder weights), or None """
+        try:
+            return np.load(os.path.join(self._entry(key), f'feat_{tag}.npy'))
+        except (OSError, ValueError):
+            return None
+
+    def put_features(self, key, tag, features):
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return
+        tmp_path = os.path.join(entry, f'.tmp-{uuid.uuid4().hex}.npy')
+        try:
+            np.save(tmp_path, np.asarray(features, dtype=np.float32))
+            os.replace(tmp_path, os.path.join(entry, f'feat_{tag}.npy'))
+        except OSError:
+            # evicted in the meantime
+            return
+        self.evict()
@@ -1,8 +1,49 @@
+import safetensors
+
+
+class SafetensorCheckpoint():
+    """ Memory-mapped safetensors file with the tensor names indexed by their top-level prefix,
+    e.g. 'audio2pose', 'face_3drecon', 'generator'. Tensors are only read when a sub-model asks for them. """
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = safetensors.safe_open(path, framework='pt', device='cpu')
+        self.prefix_index = {}
+        for k in self.handle.keys():
+            self.prefix_index.setdefault(k.split('.', 1)[0], []).append(k)
+
+    def keys(self):
+        return self.handle.keys()
+
+    def get(self, key):
+        if key in self.prefix_index:
+            names = self.prefix_index[key]
+        else:
+            names = [k for k in self.handle.keys() if key in k]
+        return {k.replace(key+'.', ''): self.handle.get_tensor(k) for k in names}
+
+
+_checkpoints = {}
+
+def load_safetensor_checkpoint(path):
+    """ Open each checkpoint once per process, all sub-models share the same mapping. """
+    if path not in _checkpoints:
+        _checkpoints[path] = SafetensorCheckpoint(path)
+    return _checkpoints[path]
+
+def release_safetensor_checkpoint(path=None):
+    if path is None:
+        _checkpoints.clear()
+    else:
+        _checkpoints.pop(path, None)
 
 
 def load_x_from_safetensor(checkpoint, key):
+    if isinstance(checkpoint, SafetensorCheckpoint):
+        return checkpoint.get(key)
+
     x_generator = {}
     for k,v in checkpoint.items():
         if key in k:
             x_generator[k.replace(key+'.', '')] = v
-    return x_generator
\ No newline at end of file
+    return x_generator
@@ -1,21 +1,80 @@
 import shutil
 import uuid
+import subprocess
 
 import os
 
 import cv2
+import numpy as np
 
-def load_video_to_cv2(input_path):
-    video_stream = cv2.VideoCapture(input_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    full_frames = [] 
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
+class FrameSource():
+    """
+    Frames of a video (or image) file, decoded lazily on iteration so that only the current
+    frame is held in memory. Every `stride`-th frame is kept, the skipped ones are grabbed
+    without decoding, and frames can be resized to `size` (w, h) right after decoding.
+    """
+
+    def __init__(self, path, stride=1, size=None, rgb=True, max_frames=None):
+        if not os.path.isfile(path):
+            raise ValueError('path must be a valid path to video/image file')
+        self.path = path
+        self.stride = stride
+        self.size = size
+        self.rgb = rgb
+        self.max_frames = max_frames
+        self.is_image = path.split('.')[-1].lower() in ['jpg', 'png', 'jpeg']
+
+        if self.is_image:
+            self.fps, self.frame_count = 25, 1
+        else:
+            video_stream = cv2.VideoCapture(path)
+            self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+            self.frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
             video_stream.release()
-            break 
-        full_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-    return full_frames
+
+    def __len__(self):
+        # from the container header, the decoded count can differ slightly
+        length = (self.frame_count + self.stride - 1) // self.stride
+        return length if self.max_frames is None else min(length, self.max_frames)
+
+    def _convert(self, frame):
+        if self.size is not None:
+            frame = cv2.resize(frame, tuple(self.size))
+        if self.rgb:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return frame
+
+    def __iter__(self):
+        if self.is_image:
+            yield self._convert(cv2.imread(self.path))
+            return
+
+        video_stream = cv2.VideoCapture(self.path)
+        try:
+            count = 0
+            while self.max_frames is None or count < self.max_frames:
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                yield self._convert(frame)
+                count += 1
+                for _ in range(self.stride - 1):
+                    video_stream.grab()
+        finally:
+            video_stream.release()
+
+    def chunks(self, chunk_size):
+        chunk = []
+        for frame in self:
+            chunk.append(frame)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def load_video_to_cv2(input_path):
+    return list(FrameSource(input_path))
 
 def save_video_with_watermark(video, audio, save_path, watermark=False):
     temp_file = str(uuid.uuid4())+'.mp4'
@@ -38,4 +97,53 @@ def save_video_with_watermark(video, audio, save_path, watermark=False):
 
         cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -filter_complex "[1]scale=100:-1[wm];[0][wm]overlay=(main_w-overlay_w)-10:10" "%s"' % (temp_file, watarmark_path, save_path)
         os.system(cmd)
-        os.remove(temp_file)
\ No newline at end of file
+        os.remove(temp_file)
+
+
+class FFmpegVideoWriter():
+    """ Stream RGB frames into a single ffmpeg process over stdin and mux the audio in the same pass,
+    so every output is encoded exactly once and no temporary video or wav is written. """
+
+    def __init__(self, save_path, audio_path=None, duration=None, fps=25):
+        self.save_path = save_path
+        self.audio_path = audio_path
+        self.duration = duration
+        self.fps = fps
+        self.proc = None
+
+    def _open(self, height, width):
+        cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(self.fps), '-i', '-']
+        if self.audio_path is not None:
+            cmd += ['-i', self.audio_path, '-map', '0:v', '-map', '1:a', '-c:a', 'aac']
+        if self.duration is not None:
+            cmd += ['-t', '%.3f' % self.duration]
+        # yuv420p needs even sizes
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', self.save_path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if self.proc is None:
+            self._open(frame.shape[0], frame.shape[1])
+        self.proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError('ffmpeg failed to write %s' % self.save_path)
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_video(save_path, frames, audio_path=None, duration=None, fps=25):
+    """ frames: iterable of RGB uint8 images, e.g. a list or a generator """
+    with FFmpegVideoWriter(save_path, audio_path, duration, fps) as writer:
+        for frame in frames:
+            writer.write(frame)